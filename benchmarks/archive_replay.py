@@ -0,0 +1,72 @@
+"""Measure offline replay throughput over a synthetic mbox file and Maildir.
+
+Writes `num_emails` generated messages to both, checks the mbox boundaries
+against the standard library's mailbox reader, then replays each archive
+with one worker process and with every core and prints the throughput.
+
+Usage: python -m benchmarks.archive_replay [num_emails] [attachment_size]
+"""
+import json
+import logging
+import mailbox
+import os
+import sys
+import tempfile
+
+from benchmarks.fake_gmail import make_raw_message
+from logs import logs
+from src.services.archive_replay import iter_mbox_spans, replay_archives
+
+RULES = [
+    {"predicate": "Any", "conditions": [{"field": "From", "predicate": "Contains", "value": "sender1"}],
+     "actions": [{"action": "Mark as read"}, {"action": "Move Message", "destination": "Newsletters"}]},
+    {"predicate": "All", "conditions": [
+        {"field": "Message", "predicate": "Contains", "value": "message 2"},
+        {"field": "received_date", "predicate": "greater than", "value": {"date": "2024-01-01", "unit": "days", "value": 0}},
+    ], "actions": [{"action": "Mark as unread"}]},
+]
+
+
+def write_archives(tmp, num_emails, attachment_size):
+    mbox_path = os.path.join(tmp, "archive.mbox")
+    maildir_path = os.path.join(tmp, "Maildir")
+    for subdir in ("cur", "new", "tmp"):
+        os.makedirs(os.path.join(maildir_path, subdir))
+    with open(mbox_path, "wb") as mbox:
+        for index in range(num_emails):
+            raw = make_raw_message(index, attachment_size if index % 4 == 0 else 0)
+            mbox.write(b"From sender@example.com Mon Aug 12 10:00:00 2024\n" + raw.replace(b"\nFrom ", b"\n>From ")
+                       + b"\n\n")
+            with open(os.path.join(maildir_path, "cur", f"{index}.bench:2,S"), "wb") as f:
+                f.write(raw)
+    return mbox_path, maildir_path
+
+
+def main():
+    num_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    attachment_size = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    with tempfile.TemporaryDirectory() as tmp:
+        logs.setup_logging(os.path.join(tmp, "replay.log"), logging.INFO, console=False)
+        mbox_path, maildir_path = write_archives(tmp, num_emails, attachment_size)
+        rules_file = os.path.join(tmp, "rules.json")
+        with open(rules_file, "w") as f:
+            json.dump(RULES, f)
+
+        spans = list(iter_mbox_spans(mbox_path))
+        assert len(spans) == len(mailbox.mbox(mbox_path)) == num_emails, len(spans)
+        print(f"{num_emails:,} messages, mbox of {os.path.getsize(mbox_path) / 2**20:.1f} MiB")
+
+        results = {}
+        for label, path in (("mbox", mbox_path), ("maildir", maildir_path)):
+            for processes in sorted({1, os.cpu_count() or 1}):
+                totals = replay_archives([path], rules_file, processes)
+                results[label, processes] = totals['rules']
+                print(f"{label:>8}, {processes:2} processes: {totals['seconds']:6.2f}s, "
+                      f"{totals['emails'] / totals['seconds']:8,.0f} emails/s, "
+                      f"{totals['bytes'] / 2**20 / totals['seconds']:6.1f} MiB/s, matches {dict(totals['rules'])}")
+        assert len({tuple(sorted(counts.items())) for counts in results.values()}) == 1, results
+        logs.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compare sequential, batched and pipelined raw fetches against the fake transport.
+
+Usage: python -m benchmarks.batch_fetch [num_messages] [latency_seconds]
+"""
+import sys
+import time
+
+from benchmarks.fake_gmail import FakeGmailHttp, build_fake_service, make_mailbox
+from src.services.gmail_service import GmailService
+from src.services.rate_limiter import RequestExecutor, TokenBucket
+
+
+def run(num_messages, latency, batch_size, workers=0):
+    http = FakeGmailHttp(make_mailbox(num_messages), latency=latency)
+    # An effectively unlimited quota so the numbers reflect round trips, not the rate limiter.
+    executor = RequestExecutor(TokenBucket(1_000_000))
+    gmail_service = GmailService(None, None, None, batch_size=batch_size, workers=workers,
+                                 service_factory=lambda: build_fake_service(http), executor=executor)
+    start = time.perf_counter()
+    emails = gmail_service.fetch_emails(num_messages)
+    elapsed = time.perf_counter() - start
+    return len(emails), http.round_trips, elapsed
+
+
+def check_partial_failure():
+    mailbox = make_mailbox(10)
+    failing_ids = ["msg00000003", "msg00000007"]
+    http = FakeGmailHttp(mailbox, failing_ids=failing_ids)
+    gmail_service = GmailService(None, None, None, batch_size=5, service=build_fake_service(http))
+    raw_messages, failed = gmail_service.get_raw_messages(list(mailbox))
+    assert sorted(failed) == failing_ids, failed
+    assert sorted(raw_messages) == sorted(set(mailbox) - set(failing_ids)), raw_messages.keys()
+    assert http.round_trips == 2, http.round_trips
+    print(f"partial failure: {len(raw_messages)} fetched, {len(failed)} failed in {http.round_trips} batches")
+
+
+def check_throttle_recovery():
+    mailbox = make_mailbox(200)
+    http = FakeGmailHttp(mailbox, throttle_rate=0.2)
+    executor = RequestExecutor(TokenBucket(10_000), max_retries=8, base_delay=0.01)
+    gmail_service = GmailService(None, None, None, batch_size=50, service=build_fake_service(http), executor=executor)
+    emails = gmail_service.fetch_emails(len(mailbox))
+    assert len(emails) == len(mailbox), len(emails)
+    print(f"throttling: {http.throttled} calls answered 429, all {len(emails)} emails fetched; {executor.stats()}")
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+
+    check_partial_failure()
+    check_throttle_recovery()
+    for label, batch_size, workers in (("sequential", None, 0), ("batch=50", 50, 0), ("batch=100", 100, 0),
+                                       ("4 workers", None, 4), ("batch=50x4", 50, 4)):
+        count, round_trips, elapsed = run(num_messages, latency, batch_size, workers)
+        print(f"{label:>10}: {count} emails, {round_trips} round trips, "
+              f"{elapsed:.2f}s ({count / elapsed:.0f} msg/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measure re-runs over an unchanged mailbox with and without the rule-decision cache.
+
+Runs a full resync (fetch, evaluate, act) and a --reprocess pass against the
+in-process fake Gmail API three times each: cold, again unchanged, and after
+editing the last rule. Reports time, Gmail API requests and reused decisions
+per run; with the cache, unchanged re-runs make no modify calls.
+
+Usage: python -m benchmarks.decision_cache [num_emails]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import main
+from benchmarks.fake_gmail import FakeGmailHttp, build_fake_service, make_mailbox
+from src.metrics import metrics
+from src.repositories.email_repository import get_email_repository
+from src.services.gmail_service import GmailService
+from src.services.rate_limiter import RequestExecutor, TokenBucket
+from src.services.rule_engine import RuleEngine
+
+RULES = [
+    {"predicate": "Any", "conditions": [{"field": "From", "predicate": "Contains", "value": "sender1"}],
+     "actions": [{"action": "Move Message", "destination": "Newsletters"}]},
+    {"predicate": "All", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "message 2"}],
+     "actions": [{"action": "Mark as unread"}]},
+    {"predicate": "All", "conditions": [{"field": "Message", "predicate": "Contains", "value": "message 3"}],
+     "actions": [{"action": "Mark as read"}]},
+]
+
+EDITED_RULES = RULES[:-1] + [{**RULES[-1], "conditions": [
+    {"field": "Message", "predicate": "Contains", "value": "message 4"}]}]
+
+
+def run(label, tmp, gmail_service, rules, decision_cache, step):
+    rules_file = os.path.join(tmp, "rules.json")
+    with open(rules_file, "w") as f:
+        json.dump(rules, f)
+    email_repo = get_email_repository(os.path.join(tmp, f"{label}.db"))
+    email_repo.create_table()
+    rule_engine = RuleEngine(rules_file, gmail_service, batch_actions=True, decision_cache=decision_cache)
+    requests_before = gmail_service.executor.stats()["requests"]
+    reused = metrics.counter("rule_decisions_reused_total", "")
+    reused_before = reused.value
+
+    start = time.perf_counter()
+    if step == "resync":
+        email_repo.delete_all()
+        main.fetch_and_process_emails(gmail_service, email_repo, rule_engine, sys.maxsize)
+    else:
+        main.reprocess_stored_emails(email_repo, rule_engine)
+    elapsed = time.perf_counter() - start
+    email_repo._conn.close()
+    return elapsed, gmail_service.executor.stats()["requests"] - requests_before, reused.value - reused_before
+
+
+def main_benchmark():
+    num_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    metrics.enable()
+    for decision_cache in (False, True):
+        print(f"decision cache {'on' if decision_cache else 'off'}:")
+        with tempfile.TemporaryDirectory() as tmp:
+            http = FakeGmailHttp(make_mailbox(num_emails))
+            executor = RequestExecutor(TokenBucket(1_000_000))
+            gmail_service = GmailService(None, None, None, batch_size=50, service=build_fake_service(http),
+                                         executor=executor, create_missing_labels=True)
+            for step in ("resync", "reprocess"):
+                for run_label, rules in (("cold", RULES), ("unchanged", RULES), ("edited", EDITED_RULES)):
+                    if step == "reprocess" and run_label == "cold":
+                        continue
+                    elapsed, requests, reused = run("emails", tmp, gmail_service, rules, decision_cache, step)
+                    print(f"  {step:>9} {run_label:>9}: {elapsed:6.2f}s, {requests:5} API requests, "
+                          f"{reused:6} decisions reused")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,62 @@
+"""Measure the memory held by a processing batch of resident Email objects.
+
+Compares the current slotted Email, with interned addresses and a body kept
+as bytes until first read, against a dict-backed model that stores every
+field as parsed and the body decoded up front.
+
+Usage: python -m benchmarks.email_memory [num_emails]
+"""
+import sys
+import time
+import tracemalloc
+
+from benchmarks.fake_gmail import make_raw_message
+from src.models.email import Email
+from src.models.mime_parser import parse_raw_message
+from src.utils import parse_date_time, to_timestamp
+
+
+class DictEmail:
+    """The Email model as it was before __slots__: a plain object with a decoded body."""
+
+    def __init__(self, message_id, sender, receiver, subject, message, received_date, status=None):
+        self.id = message_id
+        self.sender = sender
+        self.receiver = receiver
+        self.subject = subject
+        self._message = message
+        self.received_date = received_date
+        self.received_ts = to_timestamp(received_date)
+        self.status = status
+        self._body_loader = None
+
+    @classmethod
+    def from_raw_message(cls, raw_message_bytes, message_id):
+        headers, message_body = parse_raw_message(raw_message_bytes)
+        return cls(message_id, headers.get('From'), headers.get('To'), headers.get('Subject'),
+                   message_body, parse_date_time(headers.get('Date')))
+
+
+def measure(label, parse, corpus):
+    tracemalloc.start()
+    start = time.perf_counter()
+    emails = [parse(raw, f"msg{index:08d}") for index, raw in enumerate(corpus)]
+    elapsed = time.perf_counter() - start
+    resident = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{label:>10}: {resident / 2**20:7.1f} MiB resident, {resident / len(emails):6.0f} B/email, "
+          f"parsed in {elapsed:.2f}s")
+    return emails
+
+
+def main():
+    num_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    corpus = [make_raw_message(index) for index in range(num_emails)]
+    print(f"{num_emails:,} emails resident in one batch")
+    baseline = measure("dict-based", DictEmail.from_raw_message, corpus)
+    emails = measure("slotted", Email.from_raw_message, corpus)
+    assert all(email.get_field('Message') == old._message for email, old in zip(emails, baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Drive main.fetch_and_process_emails end to end against the local fake Gmail server.
+
+The server runs in a child process with a synthetic mailbox; this process
+fetches, parses, evaluates rules, saves to SQLite and applies actions over
+real HTTP, then reports throughput, per-stage p50/p99 latency from the
+metrics registry and peak RSS.
+
+Usage: python -m benchmarks.end_to_end [--size 2000] [--attachment-size 0] [--attachment-mix 1.0]
+           [--latency 0.0] [--throttle-rate 0.0] [--batch-size 50] [--workers 0]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import main
+from benchmarks.fake_gmail_server import serve
+from src.metrics import Histogram, metrics
+from src.repositories.email_repository import get_email_repository
+from src.services.gmail_service import get_gmail_service
+from src.services.rule_engine import RuleEngine
+
+RULES = [
+    {"predicate": "Any", "conditions": [{"field": "From", "predicate": "Contains", "value": "sender1"}],
+     "actions": [{"action": "Mark as read"}, {"action": "Move Message", "destination": "Newsletters"}]},
+    {"predicate": "All", "conditions": [
+        {"field": "Subject", "predicate": "Contains", "value": "message 2"},
+        {"field": "received_date", "predicate": "less than", "value": {"date": "2024-09-01", "unit": "days", "value": 0}},
+    ], "actions": [{"action": "Mark as unread"}]},
+]
+
+
+def start_server(args):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(
+        target=serve, daemon=True,
+        args=(args.size, args.attachment_size, args.attachment_mix, args.latency, args.throttle_rate),
+        kwargs={"ready": sender},
+    )
+    server.start()
+    return server, receiver.recv()
+
+
+def report(elapsed, size):
+    print(f"{size:,} emails in {elapsed:.2f}s: {size / elapsed:,.0f} emails/s")
+    for (name, labels), metric in metrics._snapshot():
+        if isinstance(metric, Histogram) and metric.count:
+            label_text = ",".join(f"{key}={value}" for key, value in labels)
+            print(f"  {name}{{{label_text}}}: n={metric.count:<6} p50={metric.quantile(0.5) * 1000:9.3f}ms "
+                  f"p99={metric.quantile(0.99) * 1000:9.3f}ms")
+    # ru_maxrss is in KiB on Linux.
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--attachment-size", type=int, default=0)
+    parser.add_argument("--attachment-mix", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+
+    server, port = start_server(args)
+    metrics.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        rules_file = os.path.join(tmp, "rules.json")
+        with open(rules_file, "w") as f:
+            json.dump(RULES, f)
+        # An effectively unlimited quota, so the numbers reflect the pipeline rather than the rate limiter.
+        gmail_service = get_gmail_service(None, None, None, args.batch_size, workers=args.workers,
+                                          quota_units_per_second=1_000_000, api_endpoint=f"http://127.0.0.1:{port}/")
+        email_repo = get_email_repository(os.path.join(tmp, "emails.db"))
+        email_repo.create_table()
+        rule_engine = RuleEngine(rules_file, gmail_service, batch_actions=True)
+        gmail_service.use_fields(rule_engine.required_fields())
+
+        start = time.perf_counter()
+        main.fetch_and_process_emails(gmail_service, email_repo, rule_engine, args.size)
+        elapsed = time.perf_counter() - start
+        email_repo._conn.close()
+    server.terminate()
+    report(elapsed, args.size)
+    print(f"Gmail API usage: {gmail_service.executor.stats()}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
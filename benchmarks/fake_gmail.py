@@ -0,0 +1,195 @@
+"""In-process fake of the Gmail v1 HTTP transport used for offline benchmarks.
+
+``FakeGmailHttp`` stands in for the ``httplib2.Http`` object that
+``googleapiclient`` sends requests through, so a real discovery-built service
+can be exercised without network access. Every call to ``request`` counts as
+one round trip and sleeps for ``latency`` seconds.
+"""
+import base64
+import json
+import random
+import threading
+import time
+import urllib.parse
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import BytesHeaderParser, Parser
+
+import httplib2
+from googleapiclient.discovery import build
+
+
+def make_raw_message(index, attachment_size=0):
+    msg = MIMEText(f"Body of synthetic message {index}.\n")
+    if attachment_size:
+        body, msg = msg, MIMEMultipart()
+        msg.attach(body)
+        attachment = MIMEApplication(random.Random(index).randbytes(attachment_size))
+        attachment.add_header('Content-Disposition', 'attachment', filename=f"report{index}.pdf")
+        msg.attach(attachment)
+    msg['From'] = f"sender{index % 50}@example.com"
+    msg['To'] = "me@example.com"
+    msg['Subject'] = f"Synthetic message {index}"
+    msg['Date'] = "Mon, 12 Aug 2024 10:00:00 +0000"
+    return msg.as_bytes()
+
+
+def make_mailbox(size, attachment_size=0, attachment_mix=1.0):
+    """Build {message id: raw message}; an `attachment_mix` fraction of messages carry the attachment."""
+    rng = random.Random(size)
+    return {
+        f"msg{index:08d}": make_raw_message(index, attachment_size if rng.random() < attachment_mix else 0)
+        for index in range(size)
+    }
+
+
+class FakeGmailHttp:
+    def __init__(self, mailbox, latency=0.0, failing_ids=(), throttle_rate=0.0, seed=0):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.failing_ids = set(failing_ids)
+        # Fraction of calls answered with 429 rateLimitExceeded.
+        self.throttle_rate = throttle_rate
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self.round_trips = 0
+        self.history_id = 1000
+        self.oldest_history_id = self.history_id
+        self.history = []
+        self.labels = {"UNREAD": "UNREAD", "INBOX": "INBOX", "Label_1": "Newsletters"}
+        self.message_labels = {}
+        self.modify_calls = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def add_message(self, message_id, raw):
+        """Deliver a new message and record it in the mailbox history."""
+        self.history_id += 1
+        self.mailbox[message_id] = raw
+        self.history.append({"id": str(self.history_id), "messagesAdded": [{"message": {"id": message_id}}]})
+
+    def delete_message(self, message_id):
+        """Delete a message and record it in the mailbox history."""
+        self.history_id += 1
+        del self.mailbox[message_id]
+        self.history.append({"id": str(self.history_id), "messagesDeleted": [{"message": {"id": message_id}}]})
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "POST" and urllib.parse.urlparse(uri).path.startswith("/batch"):
+            return self._batch(body, headers)
+        status, payload = self._dispatch(method, uri, body)
+        content = json.dumps(payload).encode("utf-8")
+        with self._lock:
+            self.bytes_sent += len(content)
+        return self._response(status), content
+
+    def _dispatch(self, method, uri, body=None):
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            with self._lock:
+                self.throttled += 1
+            return 429, self._error(429, "Too many concurrent requests for user", "rateLimitExceeded")
+        parsed = urllib.parse.urlparse(uri)
+        query = urllib.parse.parse_qs(parsed.query)
+        parts = parsed.path.rstrip("/").split("/")
+        if method == "GET" and parts[-1] == "profile":
+            return 200, {"emailAddress": "me@example.com", "messagesTotal": len(self.mailbox),
+                         "historyId": str(self.history_id)}
+        if method == "GET" and parts[-1] == "history":
+            start = int(query["startHistoryId"][0])
+            if start < self.oldest_history_id:
+                return 404, self._error(404, "Requested entity was not found.")
+            records = [record for record in self.history if int(record["id"]) > start]
+            return 200, {"history": records, "historyId": str(self.history_id)}
+        if method == "POST" and parts[-1] == "watch":
+            return 200, {"historyId": str(self.history_id), "expiration": str(int(time.time() + 7 * 86400) * 1000)}
+        if method == "POST" and parts[-1] == "stop":
+            return 204, {}
+        if method == "GET" and parts[-1] == "labels":
+            return 200, {"labels": [{"id": label_id, "name": name} for label_id, name in self.labels.items()]}
+        if method == "POST" and parts[-1] == "labels":
+            name = json.loads(body)["name"]
+            with self._lock:
+                label_id = f"Label_{len(self.labels)}"
+                self.labels[label_id] = name
+            return 200, {"id": label_id, "name": name}
+        if method == "POST" and parts[-1] in ("modify", "batchModify"):
+            request = json.loads(body or "{}")
+            ids = request.get("ids") or [urllib.parse.unquote(parts[-2])]
+            with self._lock:
+                self.modify_calls += 1
+                for message_id in ids:
+                    labels = self.message_labels.setdefault(message_id, {"INBOX", "UNREAD"})
+                    labels.update(request.get("addLabelIds", []))
+                    labels.difference_update(request.get("removeLabelIds", []))
+                # Like Gmail, label changes advance the mailbox history.
+                self.history_id += 1
+                record = {"id": str(self.history_id)}
+                for key, label_ids in (("labelsAdded", "addLabelIds"), ("labelsRemoved", "removeLabelIds")):
+                    if request.get(label_ids):
+                        record[key] = [{"message": {"id": message_id}, "labelIds": request[label_ids]}
+                                       for message_id in ids]
+                self.history.append(record)
+            return 200, {} if parts[-1] == "batchModify" else {"id": ids[0]}
+        if method == "GET" and parts[-1] == "messages":
+            limit = int(query.get("maxResults", ["100"])[0])
+            offset = int(query.get("pageToken", ["0"])[0])
+            ids = list(self.mailbox)[offset:offset + limit]
+            payload = {"messages": [{"id": message_id, "threadId": message_id} for message_id in ids],
+                       "resultSizeEstimate": len(self.mailbox)}
+            if offset + limit < len(self.mailbox):
+                payload["nextPageToken"] = str(offset + limit)
+            return 200, payload
+        if method == "GET" and parts[-2] == "messages":
+            message_id = urllib.parse.unquote(parts[-1])
+            if message_id in self.failing_ids or message_id not in self.mailbox:
+                return 404, self._error(404, "Requested entity was not found.")
+            if query.get("format", ["full"])[0] == "metadata":
+                wanted = {name.lower() for name in query.get("metadataHeaders", [])}
+                headers = BytesHeaderParser().parsebytes(self.mailbox[message_id]).items()
+                return 200, {"id": message_id, "threadId": message_id, "payload": {"headers": [
+                    {"name": name, "value": value} for name, value in headers if name.lower() in wanted
+                ]}}
+            raw = base64.urlsafe_b64encode(self.mailbox[message_id]).decode("ascii")
+            return 200, {"id": message_id, "threadId": message_id, "raw": raw}
+        return 404, self._error(404, f"Unsupported call {method} {parsed.path}")
+
+    def _batch(self, body, headers):
+        content_type = headers["content-type"]
+        boundary = content_type.split("boundary=", 1)[1].strip('"')
+        message = Parser().parsestr(f"content-type: {content_type}\r\n\r\n{body}")
+        out_boundary = "fake_batch_boundary"
+        chunks = []
+        for part in message.get_payload():
+            request_line = part.get_payload().split("\n", 1)[0]
+            method, path, _ = request_line.split(" ", 2)
+            status, payload = self._dispatch(method, "https://gmail.googleapis.com" + path)
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            data = json.dumps(payload)
+            chunks.append(
+                f"--{out_boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{data}\r\n"
+            )
+        chunks.append(f"--{out_boundary}--\r\n")
+        response = self._response(200, f'multipart/mixed; boundary="{out_boundary}"')
+        content = "".join(chunks).encode("utf-8")
+        with self._lock:
+            self.bytes_sent += len(content)
+        return response, content
+
+    @staticmethod
+    def _response(status, content_type="application/json; charset=UTF-8"):
+        return httplib2.Response({"status": status, "content-type": content_type})
+
+    @staticmethod
+    def _error(code, message, reason=None):
+        return {"error": {"code": code, "message": message, "errors": [{"message": message, "reason": reason}]}}
+
+
+def build_fake_service(http):
+    return build('gmail', 'v1', http=http, static_discovery=True, cache_discovery=False)
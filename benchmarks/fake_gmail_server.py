@@ -0,0 +1,77 @@
+"""Serve the fake Gmail v1 API over local HTTP.
+
+Wraps FakeGmailHttp in a real HTTP server, so GmailService can be pointed
+at it with api_endpoint (GMAIL_API_ENDPOINT in config) and exercise its
+real transport: messages.list paging, messages.get raw/metadata, modify,
+batchModify, labels and batch requests.
+
+Usage: python -m benchmarks.fake_gmail_server [--port 8080] [--size 1000]
+           [--attachment-size 0] [--attachment-mix 1.0] [--latency 0.0] [--throttle-rate 0.0]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.fake_gmail import FakeGmailHttp, make_mailbox
+
+
+def make_server(fake, host="127.0.0.1", port=0):
+    """Return a ThreadingHTTPServer answering every request through `fake`; port 0 picks a free port."""
+
+    class FakeGmailHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def _handle(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode("utf-8") if length else None
+            headers = {name.lower(): value for name, value in self.headers.items()}
+            response, content = fake.request(f"http://{host}{self.path}", method, body, headers)
+            self.send_response(int(response.status))
+            self.send_header("Content-Type", response["content-type"])
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), FakeGmailHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(size, attachment_size=0, attachment_mix=1.0, latency=0.0, throttle_rate=0.0, port=0, ready=None):
+    """Build a synthetic mailbox and serve it until interrupted; sends the bound port to `ready` if given."""
+    fake = FakeGmailHttp(make_mailbox(size, attachment_size, attachment_mix), latency=latency,
+                         throttle_rate=throttle_rate)
+    server = make_server(fake, port=port)
+    if ready is not None:
+        ready.send(server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic mailbox through a fake Gmail v1 API.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--size", type=int, default=1000, help="messages in the mailbox")
+    parser.add_argument("--attachment-size", type=int, default=0, help="bytes per attachment")
+    parser.add_argument("--attachment-mix", type=float, default=1.0, help="fraction of messages with an attachment")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    args = parser.parse_args()
+    print(f"Serving {args.size} messages at http://127.0.0.1:{args.port}/")
+    serve(args.size, args.attachment_size, args.attachment_mix, args.latency, args.throttle_rate, args.port)
+
+
+if __name__ == "__main__":
+    main()
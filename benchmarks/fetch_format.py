@@ -0,0 +1,45 @@
+"""Compare bytes transferred for raw and rule-aware metadata fetches.
+
+Usage: python -m benchmarks.fetch_format [num_messages] [attachment_bytes]
+"""
+import sys
+import time
+
+from benchmarks.fake_gmail import FakeGmailHttp, build_fake_service, make_mailbox
+from src.services.gmail_service import GmailService
+from src.services.rate_limiter import RequestExecutor, TokenBucket
+
+
+def run(mailbox, fields):
+    http = FakeGmailHttp(mailbox)
+    gmail_service = GmailService(None, None, None, batch_size=50, service=build_fake_service(http),
+                                 executor=RequestExecutor(TokenBucket(1_000_000)))
+    if fields is not None:
+        gmail_service.use_fields(fields)
+    start = time.perf_counter()
+    emails = gmail_service.fetch_emails(len(mailbox))
+    elapsed = time.perf_counter() - start
+    return emails, http, elapsed
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    attachment_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000
+    mailbox = make_mailbox(num_messages, attachment_size)
+
+    for label, fields in (("raw", None), ("metadata", {'From', 'Subject', 'received_date'})):
+        emails, http, elapsed = run(mailbox, fields)
+        print(f"{label:>8}: {len(emails)} emails, {http.bytes_sent / 1e6:9.2f} MB transferred, {elapsed:.2f}s")
+
+    # Rules reading the body fetch raw messages; metadata emails still load a body on access.
+    emails, http, _ = run(mailbox, {'From', 'Message'})
+    assert all(email.loaded_message for email in emails)
+    emails, http, _ = run(mailbox, {'From'})
+    before = http.bytes_sent
+    bodies = [email.message for email in emails[:10]]
+    assert all(bodies), bodies
+    print(f"lazy body: {len(bodies)} bodies fetched on access, {(http.bytes_sent - before) / 1e6:.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Measure rule engine throughput with logging at INFO versus DEBUG.
+
+Runs RuleEngine.process_email over the same emails with the application's
+queued logging writing to a temporary file, at INFO, at DEBUG, and at DEBUG
+with 1% of emails sampled.
+
+Usage: python -m benchmarks.logging_overhead [num_rules] [num_emails]
+"""
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.rule_evaluation import make_emails, make_rules
+from logs import logs
+from src.services.rule_engine import RuleEngine
+
+
+def run(rules_file, emails, logs_file, level, sample_rate):
+    logs.setup_logging(logs_file, level, sample_rate, console=False)
+    engine = RuleEngine(rules_file, gmail_service=None, batch_actions=True)
+    start = time.perf_counter()
+    for email in emails:
+        engine.process_email(email)
+    elapsed = time.perf_counter() - start
+    # Include the time the listener needs to write out what was queued.
+    logs.stop_logging()
+    total = time.perf_counter() - start
+    return len(emails) / elapsed, total, os.path.getsize(logs_file)
+
+
+def main():
+    num_rules = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    num_emails = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    rng = random.Random(0)
+    rules = [{"conditions": rule.conditions, "predicate": rule.predicate, "actions": rule.actions}
+             for rule in make_rules(num_rules, rng)]
+    emails = make_emails(num_emails, rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        rules_file = os.path.join(tmp, "rules.json")
+        with open(rules_file, 'w') as f:
+            json.dump(rules, f)
+        for label, level, sample_rate in (("INFO", logging.INFO, 1.0), ("DEBUG", logging.DEBUG, 1.0),
+                                          ("DEBUG 1% sampled", logging.DEBUG, 0.01)):
+            rate, total, size = run(rules_file, emails, os.path.join(tmp, f"{label}.log"), level, sample_rate)
+            print(f"{label:>16}: {rate:>9,.0f} emails/s evaluated, {total:6.2f}s until written, "
+                  f"{size / 2**20:7.1f} MiB logged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Compare the fast MIME parse path with the full MIME tree parse.
+
+Usage: python -m benchmarks.mime_parsing [num_messages] [attachment_bytes]
+
+Reports messages/sec and the peak memory traced while parsing a synthetic
+corpus where every message carries a large attachment.
+"""
+import sys
+import time
+import tracemalloc
+
+from benchmarks.fake_gmail import make_raw_message
+from src.models.email import Email
+
+
+def measure(parse, corpus):
+    tracemalloc.start()
+    start = time.perf_counter()
+    emails = [parse(raw, f"msg{index}") for index, raw in enumerate(corpus)]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return emails, len(corpus) / elapsed, peak
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    attachment_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000_000
+    corpus = [make_raw_message(index, attachment_size) for index in range(num_messages)]
+    print(f"corpus: {num_messages} messages, {sum(map(len, corpus)) / 1e6:.1f} MB")
+
+    results = {}
+    for label, parse in (("mime tree", Email.from_mime_tree), ("fast path", Email.from_raw_message)):
+        emails, rate, peak = measure(parse, corpus)
+        results[label] = [email.message for email in emails]
+        print(f"{label:>9}: {rate:8.1f} messages/s, peak {peak / 1e6:8.2f} MB traced")
+    assert results["mime tree"] == results["fast path"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Compare loading pending emails with get_all() against the streaming iter_pending() cursor.
+
+Most of the store is already read, as on a long-running mailbox. Reports time and
+peak Python memory for each way of visiting the pending emails.
+
+Usage: python -m benchmarks.pending_scan [row_count]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from src.models.email import Email
+from src.repositories.email_repository import columns_for_fields, get_email_repository
+from src.utils import chunked
+
+
+def make_emails(count):
+    for index in range(count):
+        yield Email(f"msg{index:08d}", f"sender{index % 500}@example.com", "me@example.com",
+                    f"Subject {index}", f"Body of message {index}. " * 100, "2024-08-12 10:00:00+00:00",
+                    status=None if index % 10 == 0 else 'read')
+
+
+def measure(label, visit):
+    tracemalloc.start()
+    start = time.perf_counter()
+    visited = visit()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:>28}: {elapsed:6.2f}s  peak {peak / 2**20:8.1f} MiB  ({visited:,} pending emails)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = get_email_repository(os.path.join(tmp, "emails.db"), full_text_index=False)
+        repo.create_table()
+        for emails in chunked(make_emails(count), 10_000):
+            repo.save_many(emails)
+
+        measure("get_all + filter", lambda: sum(1 for email in repo.get_all() if email.status != 'read'))
+        measure("iter_pending", lambda: sum(1 for _ in repo.iter_pending()))
+        columns = columns_for_fields({'From', 'Subject', 'received_date'})
+        measure("iter_pending (header columns)", lambda: sum(1 for _ in repo.iter_pending(columns=columns)))
+        repo._conn.close()
+
+
+if __name__ == "__main__":
+    main()
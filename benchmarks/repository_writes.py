@@ -0,0 +1,61 @@
+"""Measure EmailRepository write throughput: per-row commits versus bulk writes.
+
+Usage: python -m benchmarks.repository_writes [row_count ...]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from src.models.email import Email
+from src.repositories.email_repository import EmailRepository, get_email_repository
+
+
+def make_emails(count):
+    return [
+        Email(f"msg{index:08d}", f"sender{index % 500}@example.com", "me@example.com",
+              f"Subject {index}", f"Body of message {index}. " * 20, "2024-08-12 10:00:00+00:00")
+        for index in range(count)
+    ]
+
+
+def per_row(path, emails):
+    # The baseline connection: default rollback journal and synchronous=FULL.
+    repo = EmailRepository(sqlite3.connect(path))
+    repo.create_table()
+    start = time.perf_counter()
+    for email in emails:
+        repo.save(email)
+    for email in emails:
+        repo.update_status(email.id, 'read')
+    elapsed = time.perf_counter() - start
+    repo._conn.close()
+    return elapsed
+
+
+def bulk(path, emails):
+    repo = get_email_repository(path)
+    repo.create_table()
+    start = time.perf_counter()
+    repo.save_many(emails)
+    repo.update_status_many((email.id, 'read') for email in emails)
+    elapsed = time.perf_counter() - start
+    repo._conn.close()
+    return elapsed
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            emails = make_emails(count)
+            for label, writer in (("per-row", per_row), ("bulk+WAL", bulk)):
+                path = os.path.join(tmp, f"{label}-{count}.db")
+                elapsed = writer(path, emails)
+                # Each email is written twice: once on save, once on status update.
+                print(f"{count:>7} emails {label:>9}: {elapsed:7.2f}s  {2 * count / elapsed:>10,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
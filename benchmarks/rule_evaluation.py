@@ -0,0 +1,113 @@
+"""Measure rule evaluations per second for compiled rules.
+
+Usage: python -m benchmarks.rule_evaluation [num_rules] [num_emails]
+
+Also times an interpreted evaluator equivalent to the pre-compilation
+Rule.evaluate (dict lookups, if/elif dispatch and date parsing per call)
+on a slice of the emails, and the compiled rules with every substring
+field served from a PatternIndex.
+"""
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+from src.models.email import Email
+from src.services.rule_engine import EvaluationContext, Rule, RuleEngine
+from src.utils import compare_dates, parse_date, parse_date_time
+
+WORDS = ["invoice", "meeting", "newsletter", "sale", "update", "report", "alert", "welcome", "offer", "digest"]
+
+
+def make_rules(count, rng):
+    rules = []
+    for index in range(count):
+        conditions = [
+            {"field": "From", "predicate": rng.choice(["Contains", "Does not Contain"]), "value": f"sender{index % 97}"},
+            {"field": "Subject", "predicate": rng.choice(["Contains", "Equals"]), "value": rng.choice(WORDS)},
+            {"field": "received_date", "predicate": rng.choice(["less than", "greater than"]),
+             "value": {"date": "2024-08-15", "unit": "days", "value": index % 30}},
+            {"field": "Message", "predicate": "Contains", "value": f"{rng.choice(WORDS)} {rng.choice(WORDS)}"},
+        ]
+        rules.append(Rule({"conditions": conditions, "predicate": rng.choice(["All", "Any"]),
+                           "actions": [{"action": "Mark as read"}]}))
+    return rules
+
+
+def make_emails(count, rng):
+    received = datetime(2024, 8, 1, tzinfo=timezone.utc)
+    return [
+        Email(f"msg{index}", f"sender{index % 500}@example.com", "me@example.com",
+              f"{rng.choice(WORDS)} {index}", " ".join(rng.choice(WORDS) for _ in range(200)), received)
+        for index in range(count)
+    ]
+
+
+def interpreted_evaluate(rule, email):
+    results = []
+    for condition in rule.conditions:
+        field, predicate, value = condition['field'], condition['predicate'], condition['value']
+        if field == 'received_date':
+            email_date = parse_date_time(email.received_date)
+            comparison_date = parse_date(value['date'])
+            results.append(compare_dates(email_date, comparison_date, predicate,
+                                         value.get('unit', 'days'), value.get('value', 0)))
+            continue
+        email_value = email.get_field(field)
+        if predicate == 'Contains':
+            results.append(value in email_value)
+        elif predicate == 'Does not Contain':
+            results.append(value not in email_value)
+        elif predicate == 'Equals':
+            results.append(email_value == value)
+        elif predicate == 'Does not equal':
+            results.append(email_value != value)
+    return all(results) if rule.predicate == 'All' else any(results)
+
+
+def compiled_evaluate(rules, emails, indexes):
+    matched = 0
+    for email in emails:
+        context = EvaluationContext(email, indexes)
+        for rule in rules:
+            matched += rule.matches(context)
+    return matched
+
+
+def measure(evaluate, rules, emails, *args):
+    start = time.perf_counter()
+    matched = evaluate(rules, emails, *args)
+    elapsed = time.perf_counter() - start
+    return len(rules) * len(emails) / elapsed, matched
+
+
+def interpreted(rules, emails):
+    return sum(interpreted_evaluate(rule, email) for email in emails for rule in rules)
+
+
+def main():
+    num_rules = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    num_emails = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    rng = random.Random(42)
+    rules = make_rules(num_rules, rng)
+    emails = make_emails(num_emails, rng)
+
+    sample = emails[:max(1, num_emails // 20)]
+    rate, expected = measure(interpreted, rules, sample)
+    print(f"interpreted: {rate:>12,.0f} evaluations/s ({len(rules)} rules x {len(sample)} emails)")
+
+    rate, matched = measure(compiled_evaluate, rules, emails, {})
+    print(f"   compiled: {rate:>12,.0f} evaluations/s ({len(rules)} rules x {len(emails)} emails)")
+
+    indexes = RuleEngine.build_indexes(rules, min_patterns=1)
+    for rule in rules:
+        rule.compile(indexes)
+    rate, indexed_matched = measure(compiled_evaluate, rules, emails, indexes)
+    print(f"    indexed: {rate:>12,.0f} evaluations/s ({len(rules)} rules x {len(emails)} emails)")
+
+    assert matched == indexed_matched, (matched, indexed_matched)
+    assert compiled_evaluate(rules, sample, indexes) == expected
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Compare re-running rules over the local store in Python versus as planned SQL queries.
+
+Checks that both return the same matches for every rule, then times each.
+
+Usage: python -m benchmarks.rule_pushdown [row_count]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from src.models.email import Email
+from src.repositories.email_repository import get_email_repository
+from src.repositories.rule_planner import RuleQueryPlanner
+from src.services.rule_engine import Rule
+from src.utils import chunked
+
+WORDS = ["invoice", "meeting", "Report", "urgent", "lunch", "offer", "Re:", "x", "déjà vu", 'say "hi"']
+
+RULES = [
+    {"predicate": "All", "conditions": [{"field": "From", "predicate": "Equals", "value": "sender7@example.com"}]},
+    {"predicate": "All", "conditions": [{"field": "From", "predicate": "Contains", "value": "sender999@"}]},
+    {"predicate": "All", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "Report"}]},
+    {"predicate": "All", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "report"}]},
+    {"predicate": "Any", "conditions": [
+        {"field": "Subject", "predicate": "Contains", "value": "x"},
+        {"field": "From", "predicate": "Contains", "value": "sender42@"},
+    ]},
+    {"predicate": "All", "conditions": [
+        {"field": "Message", "predicate": "Contains", "value": 'say "hi"'},
+        {"field": "received_date", "predicate": "less than",
+         "value": {"date": "2024-06-01", "unit": "days", "value": 0}},
+    ]},
+    {"predicate": "All", "conditions": [
+        {"field": "Message", "predicate": "Does not Contain", "value": "déjà vu"},
+        {"field": "Subject", "predicate": "Does not equal", "value": "lunch"},
+        {"field": "received_date", "predicate": "greater than",
+         "value": {"date": "2024-01-01", "unit": "months", "value": 2}},
+    ]},
+]
+
+
+def make_emails(count, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for index in range(count):
+        yield Email(
+            f"msg{index:08d}", f"sender{rng.randrange(1000)}@example.com", "me@example.com",
+            " ".join(rng.sample(WORDS, 2)), " ".join(rng.choice(WORDS) for _ in range(30)),
+            format_datetime(start + timedelta(hours=index % 8760)),
+            status=rng.choice(("unread", None)),
+        )
+
+
+def python_scan(repo, rules):
+    emails = repo.get_all()
+    return [{email.id for email in emails if rule.evaluate(email)} for rule in rules]
+
+
+def sql_plan(repo, rules):
+    planner = RuleQueryPlanner(repo.fts_enabled)
+    return [set(repo.get_ids_where(*planner.plan(rule))) for rule in rules]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rules = [Rule({**rule, "actions": []}) for rule in RULES]
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = get_email_repository(os.path.join(tmp, "emails.db"), full_text_index=True)
+        repo.create_table()
+        start = time.perf_counter()
+        for emails in chunked(make_emails(count), 10_000):
+            repo.save_many(emails)
+        print(f"stored {count:,} emails (with full-text index: {repo.fts_enabled}) "
+              f"in {time.perf_counter() - start:.2f}s")
+
+        results = {}
+        for label, run in (("python scan", python_scan), ("sql plan", sql_plan)):
+            start = time.perf_counter()
+            results[label] = run(repo, rules)
+            print(f"{label:>11}: {time.perf_counter() - start:7.2f}s for {len(rules)} rules")
+
+        for index, (expected, actual) in enumerate(zip(results["python scan"], results["sql plan"])):
+            assert expected == actual, f"rule {index}: {len(expected)} python vs {len(actual)} sql matches"
+        print("matches agree:", [len(matches) for matches in results["sql plan"]])
+        repo._conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Measure new-mail-to-action latency of the watch daemon against the local fake Gmail server.
+
+Starts the fake server and a WatchDaemon with a socket notification source in
+this process, then repeatedly delivers a message, sends a notification and
+waits for the rule's label change to reach the server. Reports p50/p99 of that
+latency, first with notifications and then with polling only.
+
+Usage: python -m benchmarks.watch_latency [deliveries] [poll_interval]
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import main
+from benchmarks.fake_gmail import FakeGmailHttp, make_mailbox, make_raw_message
+from benchmarks.fake_gmail_server import make_server
+from config import config
+from logs import logs
+from src.services.watch_daemon import SocketNotifications, WatchDaemon
+
+RULES = [{"predicate": "Any", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "Synthetic"}],
+          "actions": [{"action": "Mark as read"}]}]
+
+
+async def measure(fake, rules_file, deliveries, poll_interval, notify):
+    source = SocketNotifications(0)
+    daemon = WatchDaemon(
+        lambda: main.initialize_services(),
+        lambda gmail_service, email_repo, rule_engine: main.sync_emails(gmail_service, email_repo, rule_engine, 1000),
+        rules_file, [source] if notify else [], poll_interval,
+    )
+    task = asyncio.create_task(daemon.run())
+    while not daemon.syncs:
+        await asyncio.sleep(0.01)
+    _, writer = await asyncio.open_connection("127.0.0.1", source.port) if notify else (None, None)
+
+    latencies = []
+    for index in range(deliveries):
+        message_id = f"new{poll_interval}-{index:06d}"
+        start = time.perf_counter()
+        fake.add_message(message_id, make_raw_message(index))
+        if writer:
+            writer.write(json.dumps({"historyId": str(fake.history_id)}).encode() + b"\n")
+            await writer.drain()
+        while "UNREAD" in fake.message_labels.get(message_id, {"UNREAD"}):
+            await asyncio.sleep(0.001)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.02)
+    if writer:
+        writer.close()
+    daemon.stop()
+    await task
+    return sorted(latencies)
+
+
+def main_benchmark():
+    deliveries = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    poll_interval = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    fake = FakeGmailHttp(make_mailbox(100))
+    server = make_server(fake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        rules_file = os.path.join(tmp, "rules.json")
+        with open(rules_file, "w") as f:
+            json.dump(RULES, f)
+        config.GMAIL_API_ENDPOINT = f"http://127.0.0.1:{server.server_port}/"
+        config.RULES_FILE = rules_file
+        config.DATABASE_FILE = os.path.join(tmp, "emails.db")
+        # An effectively unlimited quota: back-to-back deliveries would otherwise measure the rate limiter.
+        config.QUOTA_UNITS_PER_SECOND = 1_000_000
+        logs.setup_logging(os.path.join(tmp, "watch.log"), logging.INFO, console=False)
+
+        for label, interval, notify in (("notifications", None, True), (f"polling every {poll_interval}s",
+                                                                          poll_interval, False)):
+            latencies = asyncio.run(measure(fake, rules_file, deliveries, interval, notify))
+            print(f"{label:>22}: p50={latencies[len(latencies) // 2] * 1000:7.1f}ms "
+                  f"p99={latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:7.1f}ms "
+                  f"max={latencies[-1] * 1000:7.1f}ms over {len(latencies)} deliveries")
+        logs.stop_logging()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main_benchmark()
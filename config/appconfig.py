@@ -8,4 +8,31 @@ class AppConfig:
         self.scopes = config.SCOPES
         self.credentials_file = config.CREDENTIALS_FILE
         self.token_file = config.TOKEN_FILE
+        self.gmail_api_endpoint = config.GMAIL_API_ENDPOINT
         self.logs_file = config.LOGS_FILE
+        self.log_level = config.LOG_LEVEL
+        self.log_debug_sample_rate = config.LOG_DEBUG_SAMPLE_RATE
+        self.fetch_batch_size = config.FETCH_BATCH_SIZE
+        self.stream_chunk_size = config.STREAM_CHUNK_SIZE
+        self.sqlite_synchronous = config.SQLITE_SYNCHRONOUS
+        self.batch_actions = config.BATCH_ACTIONS
+        self.full_text_index = config.FULL_TEXT_INDEX
+        self.decision_cache = config.DECISION_CACHE
+        self.label_cache_ttl = config.LABEL_CACHE_TTL
+        self.create_missing_labels = config.CREATE_MISSING_LABELS
+        self.fetch_workers = config.FETCH_WORKERS
+        self.quota_units_per_second = config.QUOTA_UNITS_PER_SECOND
+        self.max_retries = config.MAX_RETRIES
+        self.fetch_format = config.FETCH_FORMAT
+        self.max_body_size = config.MAX_BODY_SIZE
+        self.metrics_enabled = config.METRICS_ENABLED
+        self.metrics_file = config.METRICS_FILE
+        self.metrics_port = config.METRICS_PORT
+        self.accounts_file = config.ACCOUNTS_FILE
+        self.account_processes = config.ACCOUNT_PROCESSES
+        self.replay_batch_size = config.REPLAY_BATCH_SIZE
+        self.watch_poll_interval = config.WATCH_POLL_INTERVAL
+        self.watch_batch_window = config.WATCH_BATCH_WINDOW
+        self.watch_notify_port = config.WATCH_NOTIFY_PORT
+        self.watch_pubsub_topic = config.WATCH_PUBSUB_TOPIC
+        self.watch_pubsub_subscription = config.WATCH_PUBSUB_SUBSCRIPTION
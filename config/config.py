@@ -3,4 +3,31 @@ RULES_FILE = "config/rules.json"
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly','https://www.googleapis.com/auth/gmail.modify']
 CREDENTIALS_FILE = "config/credentials.json"
 TOKEN_FILE = "config/token.json"
+GMAIL_API_ENDPOINT = None  # e.g. "http://127.0.0.1:8080/" for benchmarks/fake_gmail_server; None uses Google
 LOGS_FILE="logs/gmail_processor.log"
+LOG_LEVEL = "DEBUG"
+LOG_DEBUG_SAMPLE_RATE = 1.0  # fraction of emails whose per-email DEBUG lines are logged
+FETCH_BATCH_SIZE = 50
+STREAM_CHUNK_SIZE = 100
+SQLITE_SYNCHRONOUS = "NORMAL"
+BATCH_ACTIONS = True
+FULL_TEXT_INDEX = False  # trigram index for --reprocess Contains rules; maintained on every write, about 6x slower saves
+DECISION_CACHE = True  # skip emails whose content and deciding rules are unchanged since they were last handled
+LABEL_CACHE_TTL = 300
+CREATE_MISSING_LABELS = False
+FETCH_WORKERS = 0
+QUOTA_UNITS_PER_SECOND = 240
+MAX_RETRIES = 5
+FETCH_FORMAT = "auto"  # "auto" fetches only what the rules need; "raw" always downloads full messages
+MAX_BODY_SIZE = None  # bytes of message body kept per email; None keeps the whole body
+METRICS_ENABLED = False  # per-stage latency histograms, summarized at the end of a run
+METRICS_FILE = None  # Prometheus text file written at the end of a run, e.g. for node_exporter's textfile collector
+METRICS_PORT = None  # serve Prometheus metrics on 127.0.0.1:<port>/metrics while running
+ACCOUNTS_FILE = None  # JSON list of accounts to run in worker processes, see main.run_accounts
+ACCOUNT_PROCESSES = 0  # worker processes for ACCOUNTS_FILE; 0 uses one per account up to the CPU count
+REPLAY_BATCH_SIZE = 500  # messages per task handed to a --replay worker process
+WATCH_POLL_INTERVAL = 60  # seconds between --watch syncs when no notification arrives; 0 only waits for them
+WATCH_BATCH_WINDOW = 0.05  # seconds to collect a burst of notifications into one --watch sync
+WATCH_NOTIFY_PORT = None  # local TCP port whose lines trigger --watch syncs, a stand-in for Pub/Sub
+WATCH_PUBSUB_TOPIC = None  # e.g. "projects/<project>/topics/gmail"; --watch has Gmail publish changes there
+WATCH_PUBSUB_SUBSCRIPTION = None  # subscription on that topic pulled by --watch; needs google-cloud-pubsub
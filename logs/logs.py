@@ -1,40 +1,131 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import random
 
 logger = logging.getLogger("gmail_processor")
 
+# Fraction of emails whose per-email DEBUG lines are kept, see sample_debug().
+debug_sample_rate = 1.0
+
+_listener = None
+_queue_handler = None
 
 
 def log_error_for_exception(context, exception):
-    logger.error(f"Error in {context}: {exception}")
-  
-  
+    logger.error("Error in %s: %s", context, exception)
+
+
+
+def sample_debug(logger):
+    """Whether to emit the per-email DEBUG lines for the current email.
+
+    False unless DEBUG is enabled; then True for a `debug_sample_rate`
+    fraction of calls. Callers check once per email and guard each line on it.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    return debug_sample_rate >= 1.0 or random.random() < debug_sample_rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
 
-def setup_logging(logs_file):
-    """Setup logger for the application."""
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
+    The stock handler formats every record in the calling thread before
+    queueing it. The queue here never leaves the process, so records can be
+    passed through as they are and their %-style arguments merged later.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(logs_file, level=logging.DEBUG, sample_rate=1.0, console=True):
+    """Setup logger for the application.
+
+    Logging calls only put the record on a queue; a QueueListener thread
+    formats it and writes it to the log file and the console.
+    """
+    global debug_sample_rate, _listener, _queue_handler
+    stop_logging()
+    debug_sample_rate = sample_rate
+
+    logs_dir = os.path.dirname(logs_file)
+    if logs_dir and not os.path.exists(logs_dir):
+        os.makedirs(logs_dir)
 
     logger = logging.getLogger("gmail_processor")
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(level)
 
     # Create a file handler to write logs to a file
     file_handler = logging.FileHandler(logs_file)
-    file_handler.setLevel(logging.DEBUG)
     file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     file_handler.setFormatter(file_formatter)
+    handlers = [file_handler]
 
-    # Create a stream handler to print logs to the console
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.DEBUG)
-    stream_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')  # Customize the console format
-    stream_handler.setFormatter(stream_formatter)
+    if console:
+        # Create a stream handler to print logs to the console
+        stream_handler = logging.StreamHandler()
+        stream_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')  # Customize the console format
+        stream_handler.setFormatter(stream_formatter)
+        handlers.append(stream_handler)
 
-    # Add both handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    _queue_handler = DeferredQueueHandler(log_queue)
+    logger.addHandler(_queue_handler)
 
     logger.info("Logger is set up and working.")
     return logger
 
-    
\ No newline at end of file
+
+def stop_logging():
+    """Write out every queued record, then stop the listener thread and close its handlers."""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger("gmail_processor").removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = _queue_handler = None
+
+
+def listen_to_workers(worker_queue):
+    """Write records that worker processes put on `worker_queue` through this process's handlers.
+
+    Returns the started QueueListener; stop it once the workers have exited.
+    """
+    listener = logging.handlers.QueueListener(worker_queue, *_listener.handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def setup_worker_logging(worker_queue, level=logging.DEBUG, sample_rate=1.0):
+    """Send this worker process's records to the parent through `worker_queue`.
+
+    Records are formatted here, since their arguments may not survive pickling.
+    """
+    global debug_sample_rate, _listener, _queue_handler
+    debug_sample_rate = sample_rate
+    logger = logging.getLogger("gmail_processor")
+    # Drop handlers inherited from a forked parent; their listener thread does not exist here.
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    _listener = None
+    logger.setLevel(level)
+    _queue_handler = logging.handlers.QueueHandler(worker_queue)
+    logger.addHandler(_queue_handler)
+    return logger
+
+
+def set_worker_prefix(prefix):
+    """Prefix every message this worker logs from now on, e.g. with the account being processed."""
+    _queue_handler.setFormatter(logging.Formatter(f'{prefix}%(message)s'))
+
+
+# Drain the queue before the interpreter exits so the last records are written.
+atexit.register(stop_logging)
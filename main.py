@@ -1,26 +1,62 @@
 
+from src.models.email import Email
 from src.repositories.email_repository import get_email_repository
-from src.services.gmail_service import get_gmail_service
+from src.repositories.rule_planner import RuleQueryPlanner
+from src.services.gmail_service import HistoryExpiredError, get_gmail_service
+from src.services.archive_replay import replay_archives
 from src.services.rule_engine import RuleEngine
+from src.services.watch_daemon import PubSubNotifications, SocketNotifications, WatchDaemon
 from config import appconfig
+from src.metrics import metrics
+from src.utils import chunked
 from logs import logs
-import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
 
-def initialize_services():
-    """Initialize services like Gmail and Email repository."""
+# Replaced by the configured logger in main(); set here so the functions below also work when imported.
+logger = logging.getLogger("gmail_processor")
+
+def initialize_services(workers=0, account=None, compiled_rules=None):
+    """Initialize services like Gmail and Email repository.
+
+    `account` overrides the configured credentials_file, token_file,
+    database_file and rules_file; see run_accounts.
+    """
     try:
         appconfig_instance = appconfig.AppConfig()
+        account = account or {}
 
         # Initialize email repository
-        email_repo = get_email_repository(appconfig_instance.database_file)
+        email_repo = get_email_repository(
+            account.get('database_file', appconfig_instance.database_file),
+            appconfig_instance.sqlite_synchronous, appconfig_instance.full_text_index
+        )
         email_repo.create_table()
-        email_repo.delete_all()
 
         # Initialize Gmail service
-        gmail_service = get_gmail_service(appconfig_instance.credentials_file, appconfig_instance.token_file, appconfig_instance.scopes)
+        gmail_service = get_gmail_service(
+            account.get('credentials_file', appconfig_instance.credentials_file),
+            account.get('token_file', appconfig_instance.token_file), appconfig_instance.scopes,
+            appconfig_instance.fetch_batch_size, appconfig_instance.label_cache_ttl,
+            appconfig_instance.create_missing_labels, workers,
+            appconfig_instance.quota_units_per_second, appconfig_instance.max_retries,
+            appconfig_instance.max_body_size, appconfig_instance.gmail_api_endpoint
+        )
         
         # Initialize Rule Engine
-        rule_engine = RuleEngine(appconfig_instance.rules_file, gmail_service, logger)
+        rule_engine = RuleEngine(account.get('rules_file', appconfig_instance.rules_file), gmail_service, logger,
+                                 batch_actions=appconfig_instance.batch_actions, compiled_rules=compiled_rules,
+                                 decision_cache=appconfig_instance.decision_cache)
+        if appconfig_instance.fetch_format == 'auto':
+            gmail_service.use_fields(rule_engine.required_fields())
         
         return email_repo, gmail_service, rule_engine
     except Exception as e:
@@ -28,47 +64,384 @@ def initialize_services():
         raise
 
 
-def fetch_and_process_emails(gmail_service, email_repo, rule_engine,num_emails):
-    """Fetch emails and process them based on the rules."""
+def process_email_stream(email_repo, rule_engine, emails, chunk_size=100):
+    """Save and process a stream of emails, one chunk at a time. Returns the number of emails saved."""
+    saved = 0
     try:
-        emails = gmail_service.fetch_emails(num_emails)
-
-        for email in emails:
-            email_repo.save(email)
+        for emails in chunked(emails, chunk_size):
+            decisions = email_repo.get_decisions([email.id for email in emails]) if rule_engine.decision_cache else {}
+            for email in emails:
+                if email.status != 'read':
+                    rule_engine.process_email(email, decisions.get(email.id))
+            # Saved after evaluation, so the rows carry the resulting statuses.
+            email_repo.save_many(emails)
+            saved += len(emails)
+    finally:
+        # Label changes queued in batch mode are sent once for the whole run.
+        email_repo.update_status_many(rule_engine.flush_actions())
+        email_repo.save_decisions(rule_engine.take_decisions())
+    return saved
 
-        emails = email_repo.get_all()
-        for email in emails:
-            if email.status != 'read':
-                print(email)
-                rule_engine.process_email(email)
-                email_repo.update_status(email.id, email.status)
 
+def fetch_and_process_emails(gmail_service, email_repo, rule_engine, num_emails, chunk_size=100):
+    """Fetch emails and process them based on the rules, one chunk at a time."""
+    try:
+        return process_email_stream(email_repo, rule_engine, gmail_service.iter_emails(num_emails), chunk_size)
     except Exception as e:
         logger.error(f"Error fetching or processing emails: {e}")
         raise
 
 
+def sync_emails(gmail_service, email_repo, rule_engine, num_emails, chunk_size=100):
+    """Sync incrementally from the stored historyId, falling back to a full resync.
+
+    Messages that fail to fetch or parse are stored as failed ids and retried
+    by the next incremental sync, since the historyId moves past them.
+    Returns the number of emails fetched and processed.
+    """
+    history_id = email_repo.get_history_id()
+    gmail_service.take_failed_ids()
+    if history_id:
+        try:
+            changed_ids, deleted_ids, latest_history_id = gmail_service.list_history_changes(history_id)
+        except HistoryExpiredError:
+            logger.warning(f"History ID {history_id} has expired. Falling back to a full resync.")
+        else:
+            for email_id in deleted_ids:
+                email_repo.delete_by_id(email_id)
+            retry_ids = [email_id for email_id in email_repo.get_failed_ids() if email_id not in deleted_ids]
+            changed_ids = list(dict.fromkeys(retry_ids + changed_ids))
+            # Message content is immutable, so only ids missing from the store need fetching;
+            # label changes on stored messages are our own actions or user edits.
+            existing_ids = email_repo.get_existing_ids(changed_ids)
+            new_ids = [email_id for email_id in changed_ids if email_id not in existing_ids]
+            logger.info(f"Incremental sync: processing {len(new_ids)} new messages"
+                        + (f", retrying {len(retry_ids)} that failed before." if retry_ids else "."))
+            try:
+                saved = process_email_stream(
+                    email_repo, rule_engine, gmail_service.iter_emails_by_ids(new_ids), chunk_size
+                )
+            except Exception as e:
+                logger.error(f"Error fetching or processing emails: {e}")
+                raise
+            _save_sync_point(gmail_service, email_repo, latest_history_id)
+            return saved
+
+    logger.info("Running a full resync.")
+    latest_history_id = gmail_service.get_history_id()
+    email_repo.delete_all()
+    saved = fetch_and_process_emails(gmail_service, email_repo, rule_engine, num_emails, chunk_size)
+    _save_sync_point(gmail_service, email_repo, latest_history_id)
+    return saved
+
+
+def _save_sync_point(gmail_service, email_repo, latest_history_id):
+    # Failed ids are saved first: if the history id were saved alone, they would never be seen again.
+    failed_ids = gmail_service.take_failed_ids()
+    if failed_ids:
+        logger.warning(f"{len(failed_ids)} messages could not be fetched; the next sync retries them.")
+    email_repo.set_failed_ids(failed_ids)
+    email_repo.set_history_id(latest_history_id)
+
+
+def load_missing_bodies(gmail_service, email_repo, chunk_size=100):
+    """Fetch and store the bodies of pending emails that were fetched as metadata only.
+
+    Their NULL message would otherwise never match a Message condition, where
+    Rule.evaluate on the fetched email would have loaded the body.
+    """
+    email_ids = email_repo.get_ids_where("message IS NULL", pending_only=True)
+    if not email_ids:
+        return
+    logger.info(f"Fetching the bodies of {len(email_ids)} stored emails for Message rules...")
+    for chunk in chunked(email_ids, chunk_size):
+        raw_messages, failed = gmail_service.get_raw_messages(chunk)
+        messages = []
+        for email_id, raw_message in raw_messages.items():
+            email = Email.from_raw_message(raw_message, email_id, gmail_service.max_body_size)
+            if email:
+                messages.append((email_id, email.message))
+        email_repo.update_messages(messages)
+        if len(messages) < len(chunk):
+            logger.warning(f"{len(chunk) - len(messages)} bodies could not be fetched; "
+                           "those emails cannot match Message conditions.")
+
+
+def reprocess_stored_emails(email_repo, rule_engine, gmail_service=None):
+    """Re-run the rules over the local store, evaluating each rule as one SQL query.
+
+    With `gmail_service`, bodies missing from the store are fetched first when a
+    rule reads Message. Returns the number of emails matched.
+    """
+    if gmail_service is not None and 'Message' in rule_engine.required_fields():
+        load_missing_bodies(gmail_service, email_repo)
+    planner = RuleQueryPlanner(email_repo.fts_enabled)
+    matched_ids = set()
+    matched = 0
+    try:
+        for index, rule in enumerate(rule_engine.rules):
+            where, params = planner.plan(rule)
+            email_ids = email_repo.get_ids_where(where, params, pending_only=True)
+            if rule_engine.stop_after_first_match:
+                email_ids = [email_id for email_id in email_ids if email_id not in matched_ids]
+                matched_ids.update(email_ids)
+            matched += len(email_ids)
+            if rule_engine.decision_cache:
+                # Emails this rule already acted on, with unchanged content and rules, need no new API calls.
+                decided = email_repo.get_decided_ids(email_ids, rule_engine.decision_hash([index]))
+                metrics.inc('rule_decisions_reused_total', "Emails whose stored rule decision was reused.",
+                            len(decided))
+                email_ids = [email_id for email_id in email_ids if email_id not in decided]
+                logger.info("%d stored emails matched rule %s, %d already handled", len(email_ids) + len(decided),
+                            rule.name, len(decided))
+            else:
+                logger.info("%d stored emails matched rule %s", len(email_ids), rule.name)
+            if rule_engine.queue_rule_actions(rule, email_ids):
+                rule_engine.record_decisions(email_ids, index)
+    finally:
+        email_repo.update_status_many(rule_engine.flush_actions())
+        email_repo.save_decisions(rule_engine.take_decisions())
+    return matched
+
+
+# (rules, indexes) per rules file: compiled by run_accounts, and again by spawned workers that did not inherit them.
+_compiled_rules = {}
+
+
+def load_accounts(accounts_file):
+    """Read a JSON list of accounts, each with a name, token_file and database_file, and optionally
+    credentials_file, rules_file and num_emails."""
+    with open(accounts_file, 'r') as f:
+        accounts = json.load(f)
+    for account in accounts:
+        missing = {'name', 'token_file', 'database_file'} - set(account)
+        if missing:
+            raise ValueError(f"Account {account.get('name', account)} is missing {sorted(missing)}")
+    database_files = [account['database_file'] for account in accounts]
+    if len(set(database_files)) != len(database_files):
+        raise ValueError("Every account needs its own database_file")
+    return accounts
+
+
+def _init_account_worker(log_queue, log_level, sample_rate, rules_by_file):
+    global logger
+    logger = logs.setup_worker_logging(log_queue, log_level, sample_rate)
+    for rules_file, rules_data in rules_by_file.items():
+        if rules_file not in _compiled_rules:
+            _compiled_rules[rules_file] = RuleEngine.compile_rules(rules_data)
+
+
+def run_account(account, num_emails, reprocess=False, workers=0):
+    """Sync one account in an account worker process and return its summary."""
+    appconfig_instance = appconfig.AppConfig()
+    logs.set_worker_prefix(f"[{account['name']}] ")
+    summary = {'account': account['name'], 'emails': 0, 'error': None, 'api': {}}
+    start = time.perf_counter()
+    email_repo = None
+    try:
+        rules_file = account.get('rules_file', appconfig_instance.rules_file)
+        email_repo, gmail_service, rule_engine = initialize_services(workers, account, _compiled_rules[rules_file])
+        if reprocess:
+            summary['emails'] = reprocess_stored_emails(email_repo, rule_engine, gmail_service)
+        else:
+            summary['emails'] = sync_emails(gmail_service, email_repo, rule_engine,
+                                            account.get('num_emails', num_emails), appconfig_instance.stream_chunk_size)
+        summary['api'] = gmail_service.executor.stats()
+    except Exception as e:
+        logger.error(f"Account {account['name']} failed: {e}")
+        summary['error'] = str(e)
+    finally:
+        if email_repo:
+            email_repo._conn.close()
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def run_accounts(accounts_file, processes, num_emails, reprocess=False, workers=0):
+    """Run every account in `accounts_file` in a pool of worker processes and log one combined summary.
+
+    Each account gets its own SQLite file and rate limiter. Rules are compiled once per rules
+    file and shared by all the accounts a worker runs.
+    """
+    appconfig_instance = appconfig.AppConfig()
+    accounts = load_accounts(accounts_file)
+    rules_by_file = {}
+    for account in accounts:
+        rules_file = account.get('rules_file', appconfig_instance.rules_file)
+        if rules_file not in rules_by_file:
+            with open(rules_file, 'r') as f:
+                rules_by_file[rules_file] = json.load(f)
+            # Compiled here too, so bad rules fail before any worker starts and forked workers inherit them.
+            _compiled_rules[rules_file] = RuleEngine.compile_rules(rules_by_file[rules_file])
+    processes = processes or min(len(accounts), os.cpu_count() or 1)
+    logger.info(f"Running {len(accounts)} accounts in {processes} processes...")
+
+    context = multiprocessing.get_context()
+    log_queue = context.Queue()
+    listener = logs.listen_to_workers(log_queue)
+    summaries = []
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(processes, mp_context=context, initializer=_init_account_worker,
+                                 initargs=(log_queue, appconfig_instance.log_level,
+                                           appconfig_instance.log_debug_sample_rate, rules_by_file)) as pool:
+            futures = {
+                pool.submit(run_account, account, num_emails, reprocess, workers): account['name']
+                for account in accounts
+            }
+            for future in as_completed(futures):
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    # The worker process itself died, e.g. killed for memory.
+                    summary = {'account': futures[future], 'emails': 0, 'error': str(e), 'api': {}, 'seconds': 0.0}
+                summaries.append(summary)
+                logger.info(f"Account {summary['account']}: {summary['emails']} emails in {summary['seconds']:.1f}s"
+                            + (f", failed: {summary['error']}" if summary['error'] else ""))
+    finally:
+        listener.stop()
+    elapsed = time.perf_counter() - start
+
+    emails = sum(summary['emails'] for summary in summaries)
+    failed = [summary['account'] for summary in summaries if summary['error']]
+    requests = sum(summary['api'].get('requests', 0) for summary in summaries)
+    retries = sum(summary['api'].get('retries', 0) for summary in summaries)
+    logger.info(f"{len(summaries) - len(failed)} of {len(summaries)} accounts succeeded: {emails} emails "
+                f"in {elapsed:.1f}s ({emails / elapsed:.1f} emails/s), {requests} API requests, {retries} retries.")
+    if failed:
+        logger.error(f"Failed accounts: {', '.join(sorted(failed))}")
+    return summaries
+
+
+def run_watch(num_emails, workers=0, poll_interval=None, notify_port=None):
+    """Run as a daemon: keep the services warm and sync as soon as new mail is announced, until SIGINT/SIGTERM.
+
+    Notifications come from WATCH_PUBSUB_SUBSCRIPTION (Gmail push through Cloud
+    Pub/Sub) and/or a local socket on `notify_port`; without either, or as a
+    fallback, the mailbox is polled every `poll_interval` seconds.
+    """
+    appconfig_instance = appconfig.AppConfig()
+    sources = []
+    if notify_port is not None:
+        sources.append(SocketNotifications(notify_port))
+    if appconfig_instance.watch_pubsub_subscription:
+        sources.append(PubSubNotifications(appconfig_instance.watch_pubsub_subscription))
+    if not sources and not poll_interval:
+        raise ValueError("--watch needs a notification source or a poll interval")
+    daemon = WatchDaemon(
+        lambda: initialize_services(workers),
+        lambda gmail_service, email_repo, rule_engine: sync_emails(
+            gmail_service, email_repo, rule_engine, num_emails, appconfig_instance.stream_chunk_size
+        ),
+        appconfig_instance.rules_file, sources, poll_interval, appconfig_instance.watch_batch_window,
+        topic_name=appconfig_instance.watch_pubsub_topic,
+    )
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, daemon.stop)
+            except NotImplementedError:
+                # Windows event loops; Ctrl+C then interrupts asyncio.run instead.
+                pass
+        await daemon.run()
+
+    logger.info("Starting watch mode...")
+    asyncio.run(run())
+
+
+def parse_args(appconfig_instance):
+    parser = argparse.ArgumentParser(description="Fetch Gmail messages and apply the configured rules.")
+    parser.add_argument('num_emails', nargs='?', type=int, default=1,
+                        help="number of emails to fetch on a full sync (default: 1)")
+    parser.add_argument('--workers', type=int, default=appconfig_instance.fetch_workers,
+                        help="fetch threads for the concurrent fetch/parse pipeline; 0 fetches sequentially")
+    parser.add_argument('--reprocess', action='store_true',
+                        help="re-run the rules over the emails already stored instead of syncing")
+    parser.add_argument('--metrics', action='store_true', default=appconfig_instance.metrics_enabled,
+                        help="record per-stage latencies and log a summary at the end of the run")
+    parser.add_argument('--accounts', metavar='PATH', default=appconfig_instance.accounts_file,
+                        help="JSON list of accounts to run, each in a worker process; see run_accounts")
+    parser.add_argument('--processes', type=int, default=appconfig_instance.account_processes,
+                        help="worker processes for --accounts and --replay; 0 uses up to the CPU count")
+    parser.add_argument('--replay', metavar='PATH', nargs='+',
+                        help="classify local mbox files or Maildir directories with the rules, offline; "
+                             "actions are recorded, not applied")
+    parser.add_argument('--replay-report', metavar='PATH',
+                        help="write each --replay match to PATH as a JSON line")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and process new mail as it arrives; see run_watch")
+    parser.add_argument('--poll-interval', type=float, default=appconfig_instance.watch_poll_interval,
+                        help="seconds between --watch syncs when no notification arrives; 0 only waits for them")
+    parser.add_argument('--notify-port', type=int, default=appconfig_instance.watch_notify_port,
+                        help="local TCP port where each line received triggers a --watch sync")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="run under cProfile and write pstats output to PATH (main thread only)")
+    return parser.parse_args()
+
+
 def main():
     """Main entry point for the application."""
     email_repo = None
+    profiler = None
     try:
         appconfig_instance = appconfig.AppConfig()
         # Setup logger
         global logger
-        logger = logs.setup_logging(appconfig_instance.logs_file)
+        logger = logs.setup_logging(
+            appconfig_instance.logs_file, appconfig_instance.log_level, appconfig_instance.log_debug_sample_rate
+        )
         
-        num_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+        args = parse_args(appconfig_instance)
+        num_emails = args.num_emails
+
+        # Enabled before the services start, so rules compile with their timing wrappers.
+        if args.metrics or appconfig_instance.metrics_file or appconfig_instance.metrics_port:
+            metrics.enable()
+        if appconfig_instance.metrics_port:
+            metrics.serve(appconfig_instance.metrics_port)
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        if args.replay:
+            replay_archives(args.replay, appconfig_instance.rules_file, args.processes, args.replay_report,
+                            appconfig_instance.replay_batch_size, appconfig_instance.max_body_size)
+            return
+
+        if args.accounts:
+            run_accounts(args.accounts, args.processes, num_emails, args.reprocess, args.workers)
+            return
+
+        if args.watch:
+            run_watch(num_emails, args.workers, args.poll_interval, args.notify_port)
+            return
 
         # Initialize services
-        email_repo, gmail_service, rule_engine = initialize_services()
+        email_repo, gmail_service, rule_engine = initialize_services(args.workers)
 
-        # Fetch and process emails
-        fetch_and_process_emails(gmail_service, email_repo, rule_engine,num_emails)
+        if args.reprocess:
+            reprocess_stored_emails(email_repo, rule_engine, gmail_service)
+        else:
+            # Fetch and process new emails
+            sync_emails(gmail_service, email_repo, rule_engine, num_emails, appconfig_instance.stream_chunk_size)
+        logger.info(f"Gmail API usage: {gmail_service.executor.stats()}")
 
     except Exception as e:
         logger.error(f"Fatal error in main execution: {e}")
     finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info(f"Profile written to {args.profile}")
+        if metrics.enabled:
+            logger.info(f"Run metrics:\n{metrics.summary()}")
+            if appconfig_instance.metrics_file:
+                metrics.write_prometheus(appconfig_instance.metrics_file)
+            metrics.shutdown()
         # Ensure database connection is closed
+        if email_repo:
             email_repo._conn.close()
             logger.info("Database connection closed.")
 
@@ -0,0 +1,239 @@
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("gmail_processor")
+
+# Upper bounds in seconds, from microsecond rule evaluations and parses up to slow, retried API calls.
+DEFAULT_BUCKETS = (
+    0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation within its bucket, as Prometheus does."""
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Process-wide histograms and counters, keyed by name and labels.
+
+    Disabled by default: timer() then returns a shared no-op context manager
+    and counters are not touched, so instrumented code pays a single call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}  # (name, sorted label pairs) -> Histogram or Counter
+        self._help = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def enable(self):
+        self.enabled = True
+
+    def histogram(self, name, documentation, **labels):
+        return self._get(name, documentation, labels, Histogram)
+
+    def counter(self, name, documentation, **labels):
+        return self._get(name, documentation, labels, Counter)
+
+    def timer(self, name, documentation, **labels):
+        """Context manager observing the duration of its block into a histogram."""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self.histogram(name, documentation, **labels))
+
+    def inc(self, name, documentation, amount=1, **labels):
+        if self.enabled:
+            self.counter(name, documentation, **labels).inc(amount)
+
+    def timed(self, func, name, documentation, **labels):
+        """Wrap `func` so each call is observed; returns `func` itself when disabled."""
+        if not self.enabled:
+            return func
+        histogram = self.histogram(name, documentation, **labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+
+    def _get(self, name, documentation, labels, kind):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = kind()
+                    self._help.setdefault(name, documentation)
+        return metric
+
+    def _snapshot(self):
+        # Copied under the lock: the HTTP endpoint reads while other threads register metrics.
+        with self._lock:
+            return sorted(self._metrics.items(), key=lambda item: item[0])
+
+    def summary(self):
+        """Return one line per metric: counts, totals and latency percentiles."""
+        lines = []
+        for (name, labels), metric in self._snapshot():
+            label_text = f"{{{', '.join(f'{key}={value}' for key, value in labels)}}}" if labels else ""
+            if isinstance(metric, Histogram):
+                if not metric.count:
+                    continue
+                lines.append(
+                    f"{name}{label_text}: count={metric.count} total={metric.sum:.3f}s "
+                    f"mean={metric.sum / metric.count * 1000:.3f}ms p50={metric.quantile(0.5) * 1000:.3f}ms "
+                    f"p95={metric.quantile(0.95) * 1000:.3f}ms max={metric.max * 1000:.2f}ms"
+                )
+            else:
+                lines.append(f"{name}{label_text}: {metric.value}")
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """Render every metric in the Prometheus text exposition format."""
+        families = {}
+        for (name, labels), metric in self._snapshot():
+            families.setdefault(name, []).append((labels, metric))
+        lines = []
+        for name, members in families.items():
+            kind = 'histogram' if isinstance(members[0][1], Histogram) else 'counter'
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in members:
+                if kind == 'counter':
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), metric.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {metric.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the metrics to a Prometheus textfile-collector file, replacing it atomically."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+        logger.info(f"Wrote metrics to {path}")
+
+    def serve(self, port, host='127.0.0.1'):
+        """Expose the metrics at http://host:port/metrics from a background thread."""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving metrics at http://{host}:{self._server.server_port}/metrics")
+        return self._server
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+metrics = Metrics()
@@ -1,10 +1,25 @@
 
 from email.parser import BytesParser
-from src.utils import parse_date_time
+from src.metrics import metrics
+from src.models.mime_parser import parse_raw_message
+from src.utils import parse_date_time, to_timestamp
+import hashlib
 import logging
+import sys
+
+logger = logging.getLogger("gmail_processor")
+
+
+def _intern(value):
+    # Addresses repeat across a mailbox, so interning keeps one copy of each in memory.
+    # sys.intern only accepts exact str; header objects are kept as they are.
+    return sys.intern(value) if type(value) is str else value
 
 
 class Email:
+    __slots__ = ('id', 'sender', 'receiver', 'subject', '_message', '_body', 'received_date', 'received_ts',
+                 'status', '_body_loader', '_fingerprint')
+
     FIELD_MAPPING = {
         'From': 'sender',
         'To': 'receiver',
@@ -13,17 +28,83 @@ class Email:
         'received_date': 'received_date'
     }
 
-    def __init__(self, message_id, sender, receiver, subject, message, received_date, status=None):
+    def __init__(self, message_id, sender, receiver, subject, message, received_date, status=None,
+                 received_ts=None, body_loader=None):
         self.id = message_id
-        self.sender = sender
-        self.receiver = receiver
+        self.sender = _intern(sender)
+        self.receiver = _intern(receiver)
         self.subject = subject
-        self.message = message
+        # `message` may be given decoded, or as body bytes that are decoded on first access.
+        # Saving reads the body, so only emails that are never stored, such as those of an
+        # archive replay, skip decoding altogether; the sync path only defers it.
+        if isinstance(message, bytes):
+            self._message, self._body = None, message
+        else:
+            self._message, self._body = message, None
         self.received_date = received_date
+        # UTC epoch seconds, normalized once here so date rules are integer comparisons.
+        self.received_ts = received_ts if received_ts is not None else to_timestamp(received_date)
         self.status = status  # Can be 'read', 'unread', etc.
+        # Called on first access to `message` when only metadata was fetched.
+        self._body_loader = body_loader
+        self._fingerprint = None
+
+    @property
+    def message(self):
+        if self._message is None and self._body_loader is not None:
+            body_loader, self._body_loader = self._body_loader, None
+            self._message = body_loader()
+        return self.loaded_message
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+        self._body = None
+        self._body_loader = None
+
+    @property
+    def loaded_message(self):
+        """The body if it is already available, without fetching it."""
+        if self._body is not None:
+            self._message, self._body = self._body.decode(errors='ignore'), None
+        return self._message
+
+    @property
+    def fingerprint(self):
+        """Hash of the content rules read, as loaded: headers, received_ts and any body already present.
+
+        Computed once, on first access, so the value checked against the decision
+        cache is the one saved with the email. Take it before reading `message`,
+        which may load or decode the body.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(repr((self.sender, self.receiver, self.subject, self.received_ts)).encode(),
+                                     digest_size=16)
+            if self._body is not None:
+                digest.update(b'b' + self._body)
+            elif self._message is not None:
+                digest.update(b's' + str(self._message).encode(errors='ignore'))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
 
     @classmethod
-    def from_raw_message(cls, raw_message_bytes,message_id):
+    def from_raw_message(cls, raw_message_bytes, message_id, max_body_size=None):
+        with metrics.timer('email_parse_seconds', "Time to parse a raw message into an Email."):
+            try:
+                # Parse headers and locate the body without materializing attachments
+                headers, message_body = parse_raw_message(raw_message_bytes, max_body_size, decode=False)
+            except Exception as e:
+                logger.debug("Fast parse failed for message %s, using the full MIME parser: %s", message_id, e)
+                metrics.inc('email_parse_fallbacks_total', "Messages parsed with the full MIME parser.")
+                return cls.from_mime_tree(raw_message_bytes, message_id)
+            return cls(
+                message_id, headers.get('From', None), headers.get('To', None), headers.get('Subject', None),
+                message_body, parse_date_time(headers.get('Date', None))
+            )
+
+    @classmethod
+    def from_mime_tree(cls, raw_message_bytes, message_id):
+        """Parse by building the full MIME tree; slower, but tolerant of anything the fast path rejects."""
         try:
             # Parse the raw email bytes
             msg = BytesParser().parsebytes(raw_message_bytes)
@@ -49,7 +130,23 @@ class Email:
         except Exception as e:
             logging.error(f"Failed to parse email: {e}")
             return None
-        
+
+    @classmethod
+    def from_metadata_message(cls, message_resource, message_id, body_loader=None):
+        """Build an email from a format='metadata' message resource; the body is left to `body_loader`."""
+        try:
+            headers = {
+                header['name'].lower(): header['value']
+                for header in message_resource.get('payload', {}).get('headers', [])
+            }
+            return cls(
+                message_id, headers.get('from'), headers.get('to'), headers.get('subject'), None,
+                parse_date_time(headers.get('date')), body_loader=body_loader
+            )
+        except Exception as e:
+            logging.error(f"Failed to parse email metadata: {e}")
+            return None
+
     def get_field(self, field_name):
         mapped_field = self.FIELD_MAPPING.get(field_name, field_name)
         return getattr(self, mapped_field, None)
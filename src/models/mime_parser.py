@@ -0,0 +1,118 @@
+import binascii
+import quopri
+from email.parser import BytesHeaderParser
+
+UUENCODINGS = {'x-uuencode', 'uuencode', 'uue', 'x-uue'}
+
+
+class MimeParseError(Exception):
+    """Raised when the fast path cannot handle a message and the full parser should be used."""
+
+
+def parse_raw_message(raw, max_body_size=None, decode=True):
+    """Parse a raw RFC 822 message into (headers, body) without building the MIME tree.
+
+    Only header blocks are parsed. Parts are located by scanning for
+    boundaries in the raw bytes; the payloads of non-text parts are never
+    copied or decoded. The body is the first text/plain part that is not an
+    attachment, in the same depth-first order as Message.walk(), or the whole
+    payload of a non-multipart message, capped at `max_body_size` bytes.
+    With decode=False the body is returned as transfer-decoded bytes, for
+    the caller to decode as UTF-8 when it is first needed.
+    """
+    headers, body_start = _parse_headers(raw, 0, len(raw))
+    if not _has_subparts(headers):
+        body = _payload(raw, body_start, len(raw), headers, max_body_size)
+    else:
+        body = _find_in_subparts(raw, headers, body_start, len(raw), max_body_size) or b""
+    return headers, body.decode(errors='ignore') if decode else body
+
+
+def _has_subparts(headers):
+    return headers.get_content_maintype() == 'multipart' or headers.get_content_type() == 'message/rfc822'
+
+
+def _find_text_part(raw, start, end, max_body_size):
+    headers, body_start = _parse_headers(raw, start, end)
+    if headers.get_content_type() == 'text/plain' and 'attachment' not in str(headers.get('Content-Disposition', '')):
+        return _payload(raw, body_start, end, headers, max_body_size)
+    if _has_subparts(headers):
+        return _find_in_subparts(raw, headers, body_start, end, max_body_size)
+    return None
+
+
+def _find_in_subparts(raw, headers, body_start, end, max_body_size):
+    if headers.get_content_type() == 'message/rfc822':
+        return _find_text_part(raw, body_start, end, max_body_size)
+    for part_start, part_end in _iter_parts(raw, body_start, end, _boundary(headers)):
+        body = _find_text_part(raw, part_start, part_end, max_body_size)
+        if body is not None:
+            return body
+    return None
+
+
+def _parse_headers(raw, start, end):
+    if raw.startswith(b'\n', start) or raw.startswith(b'\r\n', start):
+        header_end = start
+        body_start = raw.index(b'\n', start) + 1
+    else:
+        crlf = raw.find(b'\r\n\r\n', start, end)
+        lf = raw.find(b'\n\n', start, end)
+        if crlf != -1 and (lf == -1 or crlf < lf):
+            header_end, body_start = crlf + 2, crlf + 4
+        elif lf != -1:
+            header_end, body_start = lf + 1, lf + 2
+        else:
+            header_end = body_start = end
+    return BytesHeaderParser().parsebytes(raw[start:header_end]), body_start
+
+
+def _boundary(headers):
+    boundary = headers.get_boundary()
+    if not boundary:
+        raise MimeParseError("multipart entity without a boundary")
+    return boundary.encode('ascii', 'surrogateescape')
+
+
+def _iter_parts(raw, start, end, boundary):
+    """Yield (start, end) offsets of each body part between boundary delimiters."""
+    delimiter = b'--' + boundary
+    part_start = None
+    pos = start
+    while True:
+        index = raw.find(delimiter, pos, end)
+        if index == -1:
+            if part_start is not None:
+                yield part_start, end
+            return
+        after = index + len(delimiter)
+        # A delimiter only counts at the start of a line and when not just a prefix of a longer line.
+        if (index != start and raw[index - 1] != 0x0A) or raw[after:after + 1] not in (b'\r', b'\n', b'-', b' ', b'\t', b''):
+            pos = after
+            continue
+        if part_start is not None:
+            part_end = index - 1 if index > part_start else index
+            if part_end > part_start and raw[part_end - 1] == 0x0D:
+                part_end -= 1
+            yield part_start, max(part_start, part_end)
+        if raw.startswith(b'--', after):
+            return
+        line_end = raw.find(b'\n', after, end)
+        if line_end == -1:
+            return
+        part_start = pos = line_end + 1
+
+
+def _payload(raw, start, end, headers, max_body_size):
+    encoding = str(headers.get('Content-Transfer-Encoding', '')).strip().lower()
+    if encoding == 'base64':
+        data = binascii.a2b_base64(raw[start:end])
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(raw[start:end])
+    elif encoding in UUENCODINGS:
+        raise MimeParseError(f"unsupported transfer encoding {encoding}")
+    else:
+        data = raw[start:end if max_body_size is None else min(end, start + max_body_size)]
+    if max_body_size is not None:
+        data = data[:max_body_size]
+    return data
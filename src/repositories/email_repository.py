@@ -1,13 +1,71 @@
+import functools
+import json
 import sqlite3
+from src.metrics import metrics
 from src.models.email import Email
+from src.utils import to_timestamp
 import logging
 
 logger = logging.getLogger("gmail_processor")
 
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Column order matches the Email constructor, so rows can be unpacked into it.
+EMAIL_COLUMNS = 'id, sender, receiver, subject, message, received_date, status, received_ts'
+
+# Emails the rules still apply to; main.py skips those already marked read.
+PENDING_EMAILS = "status IS NOT 'read'"
+
+# Upsert rather than INSERT OR REPLACE: REPLACE deletes the old row without
+# firing delete triggers, which would leave stale entries in emails_fts.
+UPSERT_EMAIL = f'''
+    INSERT INTO emails ({EMAIL_COLUMNS}, fingerprint)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        sender = excluded.sender, receiver = excluded.receiver, subject = excluded.subject,
+        message = excluded.message, received_date = excluded.received_date,
+        status = excluded.status, received_ts = excluded.received_ts, fingerprint = excluded.fingerprint
+'''
+
+# One row per email the rules have decided, see RuleEngine.decision_hash. The fingerprint
+# is copied from the stored email, so a decision only holds while its content is unchanged.
+UPSERT_DECISION = '''
+    INSERT INTO rule_decisions (email_id, fingerprint, rules_hash, rules, actions)
+    SELECT id, fingerprint, ?, ?, ? FROM emails WHERE id = ?
+    ON CONFLICT (email_id) DO UPDATE SET
+        fingerprint = excluded.fingerprint, rules_hash = excluded.rules_hash,
+        rules = excluded.rules, actions = excluded.actions
+'''
+
+# Trigram index over the text columns, kept in sync with emails by triggers.
+# case_sensitive matches the semantics of Python's `in`.
+FTS_SCHEMA = (
+    '''CREATE VIRTUAL TABLE emails_fts USING fts5(
+        sender, receiver, subject, message,
+        content='emails', content_rowid='rowid', tokenize='trigram case_sensitive 1'
+    )''',
+    '''CREATE TRIGGER emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, sender, receiver, subject, message)
+        VALUES (new.rowid, new.sender, new.receiver, new.subject, new.message);
+    END''',
+    '''CREATE TRIGGER emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, sender, receiver, subject, message)
+        VALUES ('delete', old.rowid, old.sender, old.receiver, old.subject, old.message);
+    END''',
+    '''CREATE TRIGGER emails_fts_update AFTER UPDATE OF sender, receiver, subject, message ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, sender, receiver, subject, message)
+        VALUES ('delete', old.rowid, old.sender, old.receiver, old.subject, old.message);
+        INSERT INTO emails_fts (rowid, sender, receiver, subject, message)
+        VALUES (new.rowid, new.sender, new.receiver, new.subject, new.message);
+    END''',
+)
+
 class EmailRepository:
-    def __init__(self, conn):
+    def __init__(self, conn, full_text_index=False):
         self._conn = conn
         self._cursor = conn.cursor()
+        self.full_text_index = full_text_index
+        self.fts_enabled = False
 
     def create_table(self):
         try:
@@ -19,7 +77,34 @@ class EmailRepository:
                     subject TEXT,
                     message TEXT,
                     received_date DATETIME,
-                    status TEXT
+                    status TEXT,
+                    received_ts INTEGER,
+                    fingerprint TEXT
+                )
+            ''')
+            self._migrate_received_ts()
+            self._migrate_fingerprint()
+            self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_received_ts ON emails (received_ts)")
+            # Equals conditions on the header columns are index lookups.
+            for column in ('sender', 'receiver', 'subject'):
+                self._cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_emails_{column} ON emails ({column})")
+            # Partial index holding only pending rows, so it stays small as mail gets handled.
+            self._cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_emails_pending ON emails (status) WHERE {PENDING_EMAILS}")
+            self.fts_enabled = self._create_fts() if self.full_text_index else self._drop_fts()
+            self._cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+            # Kept apart from emails so decisions survive a full resync, which deletes every email.
+            self._cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rule_decisions (
+                    email_id TEXT PRIMARY KEY,
+                    fingerprint TEXT,
+                    rules_hash TEXT,
+                    rules TEXT,
+                    actions TEXT
                 )
             ''')
             self._conn.commit()
@@ -27,21 +112,78 @@ class EmailRepository:
             logger.error(f"Error creating emails table: {e}")
             raise
 
-    def save(self, email):
+    def _migrate_received_ts(self):
+        """Add and backfill the received_ts column on stores created before it existed."""
+        self._cursor.execute("PRAGMA table_info(emails)")
+        if 'received_ts' in {row[1] for row in self._cursor.fetchall()}:
+            return
+        logger.info("Adding received_ts column to the emails table...")
+        self._cursor.execute("ALTER TABLE emails ADD COLUMN received_ts INTEGER")
+        self._cursor.execute("SELECT id, received_date FROM emails")
+        rows = self._cursor.fetchall()
+        self._cursor.executemany(
+            "UPDATE emails SET received_ts = ? WHERE id = ?",
+            ((to_timestamp(received_date), email_id) for email_id, received_date in rows)
+        )
+
+    def _migrate_fingerprint(self):
+        """Add the fingerprint column on stores created before it; existing rows miss the decision cache once."""
+        self._cursor.execute("PRAGMA table_info(emails)")
+        if 'fingerprint' not in {row[1] for row in self._cursor.fetchall()}:
+            self._cursor.execute("ALTER TABLE emails ADD COLUMN fingerprint TEXT")
+
+    def _create_fts(self):
+        """Create the emails_fts index if this SQLite build supports it. Returns whether it is usable."""
+        self._cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'")
+        if self._cursor.fetchone():
+            return True
         try:
-            self._cursor.execute('''
-                INSERT OR REPLACE INTO emails 
-                (id, sender, receiver, subject, message, received_date, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (email.id, email.sender, email.receiver, email.subject, email.message, email.received_date, email.status))
-            self._conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Error saving email: {e}")
-            raise
+            for statement in FTS_SCHEMA:
+                self._cursor.execute(statement)
+        except sqlite3.OperationalError as e:
+            # FTS5 or its trigram tokenizer (SQLite 3.34+) is missing; Contains falls back to instr().
+            logger.warning(f"Full-text index unavailable, substring rules will scan: {e}")
+            return False
+        logger.info("Building the full-text index over stored emails...")
+        self._cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+        return True
+
+    def _drop_fts(self):
+        """Remove the emails_fts index and its triggers so writes stop maintaining it."""
+        for trigger in ('emails_fts_insert', 'emails_fts_delete', 'emails_fts_update'):
+            self._cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        self._cursor.execute("DROP TABLE IF EXISTS emails_fts")
+        return False
+
+    @staticmethod
+    def _row(email):
+        # Bodies are stored decoded, so SQL string functions and the FTS index see the text Rule.evaluate does.
+        return (email.id, email.sender, email.receiver, email.subject, email.loaded_message,
+                email.received_date, email.status, email.received_ts, email.fingerprint)
+
+    def save(self, email):
+        with metrics.timer('sqlite_write_seconds', "SQLite write transaction latency.", operation='save'):
+            try:
+                self._cursor.execute(UPSERT_EMAIL, self._row(email))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Error saving email: {e}")
+                raise
+
+    def save_many(self, emails):
+        """Insert or replace many emails in a single transaction."""
+        with metrics.timer('sqlite_write_seconds', "SQLite write transaction latency.", operation='save_many'):
+            try:
+                self._cursor.executemany(UPSERT_EMAIL, (self._row(email) for email in emails))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._conn.rollback()
+                logger.error(f"Error saving emails: {e}")
+                raise
 
     def get_all(self):
         try:
-            self._cursor.execute('SELECT id, sender, receiver, subject, message, received_date, status FROM emails')
+            self._cursor.execute(f'SELECT {EMAIL_COLUMNS} FROM emails')
             return [Email(*row) for row in self._cursor.fetchall()]
         except sqlite3.Error as e:
             logger.error(f"Error fetching all emails: {e}")
@@ -49,43 +191,245 @@ class EmailRepository:
 
     def get_by_id(self, email_id):
         try:
-            self._cursor.execute('SELECT id, sender, receiver, subject, message, received_date, status FROM emails WHERE id = ?', (email_id,))
+            self._cursor.execute(f'SELECT {EMAIL_COLUMNS} FROM emails WHERE id = ?', (email_id,))
             row = self._cursor.fetchone()
             return Email(*row) if row else None
         except sqlite3.Error as e:
             logger.error(f"Error fetching email by ID: {e}")
             return None
 
-    def update_status(self, email_id, status):
+    def iter_pending(self, batch_size=1000, columns=None):
+        """Yield emails not yet marked read, reading `batch_size` rows at a time.
+
+        `columns` limits the columns loaded (see columns_for_fields); id and
+        status are always loaded and other unloaded attributes are None,
+        except the body, which is read from the store on first access. Emails
+        loaded with a projection should not be saved back.
+        """
+        selected = ['id', 'status'] + [column for column in (columns or EMAIL_COLUMNS.split(', '))
+                                       if column not in ('id', 'status')]
+        unknown = set(selected) - set(EMAIL_COLUMNS.split(', '))
+        if unknown:
+            raise ValueError(f"Unknown email columns: {sorted(unknown)}")
+        # A cursor of its own, so repository calls made while iterating don't reset it.
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(f"SELECT {', '.join(selected)} FROM emails WHERE {PENDING_EMAILS}")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    values = dict(zip(selected, row))
+                    body_loader = None if 'message' in values else functools.partial(self.get_message_body, values['id'])
+                    yield Email(values['id'], values.get('sender'), values.get('receiver'), values.get('subject'),
+                                values.get('message'), values.get('received_date'), values['status'],
+                                values.get('received_ts'), body_loader)
+        except sqlite3.Error as e:
+            logger.error(f"Error iterating pending emails: {e}")
+            raise
+        finally:
+            cursor.close()
+
+    def get_message_body(self, email_id):
         try:
-            self._cursor.execute("UPDATE emails SET status = ? WHERE id = ?", (status, email_id))
+            row = self._conn.execute("SELECT message FROM emails WHERE id = ?", (email_id,)).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching body for email ID {email_id}: {e}")
+            raise
+
+    def get_ids_where(self, where, params=(), pending_only=False):
+        """Return the ids of emails matching a WHERE clause, e.g. one built by RuleQueryPlanner."""
+        if pending_only:
+            where = f"{PENDING_EMAILS} AND ({where})"
+        try:
+            self._cursor.execute(f"SELECT id FROM emails WHERE {where}", params)
+            return [row[0] for row in self._cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error querying emails: {e}")
+            raise
+
+    def get_existing_ids(self, email_ids):
+        existing = set()
+        try:
+            for start in range(0, len(email_ids), 500):
+                chunk = email_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                self._cursor.execute(f"SELECT id FROM emails WHERE id IN ({placeholders})", chunk)
+                existing.update(row[0] for row in self._cursor.fetchall())
+            return existing
+        except sqlite3.Error as e:
+            logger.error(f"Error checking for existing emails: {e}")
+            raise
+
+    def get_decisions(self, email_ids):
+        """Return {email id: (fingerprint, rules hash, matched rules JSON)} for the decided ones among `email_ids`."""
+        decisions = {}
+        try:
+            for start in range(0, len(email_ids), 500):
+                chunk = email_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                self._cursor.execute(
+                    f"SELECT email_id, fingerprint, rules_hash, rules FROM rule_decisions WHERE email_id IN ({placeholders})",
+                    chunk
+                )
+                decisions.update((row[0], tuple(row[1:])) for row in self._cursor.fetchall())
+            return decisions
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching rule decisions: {e}")
+            raise
+
+    def get_decided_ids(self, email_ids, rules_hash):
+        """Return the ids among `email_ids` decided under `rules_hash` whose stored content has not changed since."""
+        decided = set()
+        try:
+            for start in range(0, len(email_ids), 500):
+                chunk = email_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                self._cursor.execute(f'''
+                    SELECT d.email_id FROM rule_decisions d JOIN emails e ON e.id = d.email_id
+                    WHERE d.email_id IN ({placeholders}) AND d.rules_hash = ? AND d.fingerprint = e.fingerprint
+                ''', (*chunk, rules_hash))
+                decided.update(row[0] for row in self._cursor.fetchall())
+            return decided
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching rule decisions: {e}")
+            raise
+
+    def save_decisions(self, decisions):
+        """Save (email id, rules hash, matched rules JSON, applied actions JSON) rows in a single transaction.
+
+        Call after the emails are saved; decisions for emails missing from the store are dropped.
+        """
+        with metrics.timer('sqlite_write_seconds', "SQLite write transaction latency.", operation='save_decisions'):
+            try:
+                self._cursor.executemany(
+                    UPSERT_DECISION,
+                    ((rules_hash, rules, actions, email_id) for email_id, rules_hash, rules, actions in decisions)
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._conn.rollback()
+                logger.error(f"Error saving rule decisions: {e}")
+                raise
+
+    def update_messages(self, messages):
+        """Store many bodies in a single transaction from (email_id, message) pairs."""
+        with metrics.timer('sqlite_write_seconds', "SQLite write transaction latency.", operation='update_messages'):
+            try:
+                self._cursor.executemany(
+                    "UPDATE emails SET message = ? WHERE id = ?",
+                    ((message, email_id) for email_id, message in messages)
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._conn.rollback()
+                logger.error(f"Error updating email bodies: {e}")
+                raise
+
+    def get_history_id(self):
+        try:
+            self._cursor.execute("SELECT value FROM sync_state WHERE key = 'history_id'")
+            row = self._cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching history ID: {e}")
+            return None
+
+    def set_history_id(self, history_id):
+        try:
+            self._cursor.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('history_id', ?)", (str(history_id),)
+            )
             self._conn.commit()
         except sqlite3.Error as e:
-            logger.error(f"Error updating status for email ID {email_id}: {e}")
+            logger.error(f"Error saving history ID {history_id}: {e}")
             raise
 
+    def get_failed_ids(self):
+        """Ids the last sync could not fetch, to be retried by the next one."""
+        try:
+            self._cursor.execute("SELECT value FROM sync_state WHERE key = 'failed_ids'")
+            row = self._cursor.fetchone()
+            return json.loads(row[0]) if row else []
+        except sqlite3.Error as e:
+            logger.error(f"Error fetching failed message IDs: {e}")
+            return []
+
+    def set_failed_ids(self, email_ids):
+        try:
+            self._cursor.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('failed_ids', ?)", (json.dumps(sorted(email_ids)),)
+            )
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error saving failed message IDs: {e}")
+            raise
+
+    def update_status(self, email_id, status):
+        with metrics.timer('sqlite_write_seconds', "SQLite write transaction latency.", operation='update_status'):
+            try:
+                self._cursor.execute("UPDATE emails SET status = ? WHERE id = ?", (status, email_id))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Error updating status for email ID {email_id}: {e}")
+                raise
+
+    def update_status_many(self, statuses):
+        """Update many statuses in a single transaction from (email_id, status) pairs."""
+        with metrics.timer('sqlite_write_seconds', "SQLite write transaction latency.", operation='update_status_many'):
+            try:
+                self._cursor.executemany(
+                    "UPDATE emails SET status = ? WHERE id = ?",
+                    ((status, email_id) for email_id, status in statuses)
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._conn.rollback()
+                logger.error(f"Error updating email statuses: {e}")
+                raise
+
     def delete_by_id(self, email_id):
         try:
             self._cursor.execute("DELETE FROM emails WHERE id = ?", (email_id,))
+            self._cursor.execute("DELETE FROM rule_decisions WHERE email_id = ?", (email_id,))
             self._conn.commit()
         except sqlite3.Error as e:
             logger.error(f"Error deleting email by ID {email_id}: {e}")
             raise
 
     def delete_all(self):
+        """Delete every stored email. Rule decisions are kept, so a resync can reuse them."""
         try:
             self._cursor.execute("DELETE FROM emails")
             self._conn.commit()
         except sqlite3.Error as e:
-            logger.error("Error deleting all emails: {e}")
+            logger.error(f"Error deleting all emails: {e}")
             raise
 
 
-def get_email_repository(database_file):
+def columns_for_fields(fields):
+    """Map rule fields such as {'From', 'received_date'} to the email columns that serve them."""
+    columns = set()
+    for field in fields:
+        column = Email.FIELD_MAPPING.get(field, field)
+        # Date conditions compare the epoch column.
+        columns.update(('received_date', 'received_ts') if column == 'received_date' else (column,))
+    return [column for column in EMAIL_COLUMNS.split(', ') if column in columns]
+
+
+def get_email_repository(database_file, synchronous='NORMAL', full_text_index=False):
+    if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"synchronous must be one of {SYNCHRONOUS_LEVELS}, got {synchronous!r}")
     try:
         conn = sqlite3.connect(database_file)
         conn.row_factory = sqlite3.Row  # Allow column-based access for debugging
-        return EmailRepository(conn)
+        # WAL lets a commit append to the log instead of rewriting pages, and
+        # with synchronous=NORMAL it only fsyncs at checkpoints.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={synchronous.upper()}")
+        return EmailRepository(conn, full_text_index)
     except sqlite3.Error as e:
         logger.error(f"Error connecting to the database: {e}")
         raise
@@ -0,0 +1,85 @@
+import logging
+from src.models.email import Email
+from src.services.rule_engine import date_threshold
+
+logger = logging.getLogger("gmail_processor")
+
+# Columns a rule may compare against; field names are interpolated into SQL, so only these are allowed.
+TEXT_COLUMNS = ('id', 'sender', 'receiver', 'subject', 'message', 'received_date', 'status')
+
+# Columns covered by the emails_fts trigram index.
+FTS_COLUMNS = ('sender', 'receiver', 'subject', 'message')
+
+# Trigram tokens are three characters long, so shorter patterns cannot use the index.
+MIN_FTS_PATTERN_LENGTH = 3
+
+DATE_OPERATORS = {'less than': '<', 'greater than': '>'}
+
+NEVER = ('0', [])
+
+
+class RuleQueryPlanner:
+    """Translate rules into parameterized WHERE clauses over the emails table.
+
+    The clauses select exactly the rows Rule.evaluate would match: Equals
+    compares indexed columns, Contains goes through the emails_fts trigram
+    index (or instr() for short patterns), and dates are received_ts ranges.
+    A NULL column never matches, as on the stored row. Metadata fetches store
+    every header column, and main.load_missing_bodies fills in the bodies of
+    emails fetched as metadata only before Message rules run.
+    """
+
+    def __init__(self, fts_enabled=True):
+        self.fts_enabled = fts_enabled
+
+    def plan(self, rule):
+        """Return a (where clause, params) pair selecting the emails `rule` matches."""
+        clauses, params = [], []
+        for condition in rule.conditions:
+            clause, condition_params = self.plan_condition(condition)
+            clauses.append(f"({clause})")
+            params.extend(condition_params)
+        if not clauses:
+            return ('1' if rule.predicate == 'All' else '0'), []
+        return (' AND ' if rule.predicate == 'All' else ' OR ').join(clauses), params
+
+    def plan_condition(self, condition):
+        field = condition['field']
+        predicate = condition['predicate']
+        value = condition['value']
+
+        if field == 'received_date':
+            threshold = date_threshold(value)
+            if threshold is None or predicate not in DATE_OPERATORS:
+                logger.warning(f"Unsupported date condition: {condition}")
+                return NEVER
+            return f"received_ts {DATE_OPERATORS[predicate]} ?", [threshold]
+
+        column = Email.FIELD_MAPPING.get(field, field)
+        if column not in TEXT_COLUMNS:
+            # Rule.evaluate reads a missing attribute as None, which never matches.
+            return NEVER
+        if not isinstance(value, str):
+            if predicate == 'Does not equal':
+                return f"{column} IS NOT NULL", []
+            return NEVER
+
+        if predicate == 'Equals':
+            return f"{column} = ?", [value]
+        if predicate == 'Does not equal':
+            return f"{column} != ?", [value]
+        if predicate == 'Contains':
+            return self.plan_contains(column, value)
+        if predicate == 'Does not Contain':
+            clause, params = self.plan_contains(column, value)
+            return f"{column} IS NOT NULL AND NOT ({clause})", params
+        logger.warning(f"Unsupported predicate: {predicate}")
+        return NEVER
+
+    def plan_contains(self, column, value):
+        if self.fts_enabled and column in FTS_COLUMNS and len(value) >= MIN_FTS_PATTERN_LENGTH:
+            # A quoted phrase of trigrams matches exactly the rows containing the substring.
+            phrase = value.replace('"', '""')
+            return ("emails.rowid IN (SELECT rowid FROM emails_fts WHERE emails_fts MATCH ?)",
+                    [f'{column} : "{phrase}"'])
+        return f"instr({column}, ?) > 0", [value]
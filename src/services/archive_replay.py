@@ -0,0 +1,221 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+
+from logs import logs
+from src.models.email import Email
+from src.services.rule_engine import RuleEngine
+from src.utils import chunked
+
+logger = logging.getLogger("gmail_processor")
+
+MBOX_SEPARATOR = b'\nFrom '
+
+
+class RecordingGmailService:
+    """Stands in for GmailService during a replay: actions are recorded instead of sent."""
+
+    def __init__(self):
+        self.actions = []
+
+    def mark_as_read(self, message_id):
+        self.actions.append({'action': 'Mark as read'})
+
+    def mark_as_unread(self, message_id):
+        self.actions.append({'action': 'Mark as unread'})
+
+    def move_message(self, message_id, destination):
+        self.actions.append({'action': 'Move Message', 'destination': destination})
+
+    def take_actions(self):
+        actions, self.actions = self.actions, []
+        return actions
+
+
+def iter_mbox_spans(path):
+    """Yield the (start, end) byte offsets of each message in an mbox file, excluding its From_ line.
+
+    The file is memory-mapped and scanned for separators in place, so nothing is copied.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            if mm[:5] == b'From ':
+                start = 0
+            else:
+                separator = mm.find(MBOX_SEPARATOR)
+                if separator == -1:
+                    return
+                start = separator + 1
+            while True:
+                separator = mm.find(MBOX_SEPARATOR, start)
+                end = len(mm) if separator == -1 else separator + 1
+                body_start = mm.find(b'\n', start, end) + 1
+                if body_start and body_start < end:
+                    yield body_start, end
+                if separator == -1:
+                    return
+                start = separator + 1
+
+
+def iter_maildir_files(path):
+    """Yield the message files of a Maildir, streaming its cur and new directories."""
+    if not any(os.path.isdir(os.path.join(path, subdir)) for subdir in ('cur', 'new')):
+        raise ValueError(f"{path} is not a Maildir: it has no cur or new directory")
+    for subdir in ('cur', 'new'):
+        try:
+            with os.scandir(os.path.join(path, subdir)) as entries:
+                for entry in entries:
+                    if not entry.name.startswith('.') and entry.is_file():
+                        yield entry.path
+        except FileNotFoundError:
+            continue
+
+
+def iter_batches(paths, batch_size=500):
+    """Yield ('mbox', path, spans) and ('maildir', path, files) batches covering every archive in `paths`.
+
+    Directories are read as Maildirs and anything else as an mbox file.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for files in chunked(iter_maildir_files(path), batch_size):
+                yield 'maildir', path, files
+        else:
+            for spans in chunked(iter_mbox_spans(path), batch_size):
+                yield 'mbox', path, spans
+
+
+# Per worker process, set up by _init_replay_worker.
+_engine = None
+_recorder = None
+_max_body_size = None
+_mmaps = {}
+
+
+def _init_replay_worker(log_queue, log_level, rules_file, max_body_size):
+    global logger, _engine, _recorder, _max_body_size
+    logger = logs.setup_worker_logging(log_queue, log_level)
+    _recorder = RecordingGmailService()
+    _engine = RuleEngine(rules_file, _recorder)
+    _max_body_size = max_body_size
+
+
+def _mbox_map(path):
+    # Each worker maps an archive once and slices the messages of every batch out of it.
+    mm = _mmaps.get(path)
+    if mm is None:
+        with open(path, 'rb') as f:
+            mm = _mmaps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mm
+
+
+def classify_batch(batch):
+    """Parse and evaluate one batch from iter_batches in a worker process and return its tallies."""
+    kind, path, items = batch
+    result = {'emails': 0, 'bytes': 0, 'failed': 0, 'rules': Counter(), 'actions': Counter(), 'matches': []}
+    for item in items:
+        try:
+            if kind == 'mbox':
+                start, end = item
+                raw = _mbox_map(path)[start:end]
+                message_id = f"{os.path.basename(path)}:{start}"
+            else:
+                with open(item, 'rb') as f:
+                    raw = f.read()
+                # Maildir file names are "<unique>:2,<flags>"; the flags change as mail is read.
+                message_id = os.path.basename(item).split(':')[0]
+            result['bytes'] += len(raw)
+            email = Email.from_raw_message(raw, message_id, _max_body_size)
+        except Exception as e:
+            logger.warning(f"Failed to read message {item} from {path}: {e}")
+            email = None
+        if email is None:
+            result['failed'] += 1
+            continue
+        result['emails'] += 1
+        matched = _engine.process_email(email)
+        actions = _recorder.take_actions()
+        if not matched:
+            continue
+        names = [_engine.rules[index].name for index in matched]
+        result['rules'].update(names)
+        result['actions'].update(action['action'] for action in actions)
+        received_date = email.received_date
+        result['matches'].append({
+            'id': email.id, 'from': str(email.sender), 'subject': str(email.subject),
+            'date': received_date.isoformat() if isinstance(received_date, datetime) else received_date,
+            'rules': names, 'actions': actions,
+        })
+    return result
+
+
+def _ordered_map(pool, func, items, limit):
+    """Like pool.map, but keeps at most `limit` items submitted, so a huge archive is never listed in full."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def replay_archives(paths, rules_file, processes=0, report_file=None, batch_size=500, max_body_size=None,
+                    log_level=logging.WARNING):
+    """Classify every message in the mbox files and Maildirs in `paths` with the rules, offline.
+
+    Messages are parsed and evaluated in a pool of worker processes; actions are
+    recorded, not applied. Matches are written to `report_file` as JSON lines and
+    a summary of matches per rule, actions and throughput is logged and returned.
+    Workers log at `log_level`, WARNING by default, since per-email lines would
+    dominate a large replay.
+    """
+    # Compiled here only to fail fast on a bad rules file; each worker loads its own.
+    with open(rules_file, 'r') as f:
+        rules, _ = RuleEngine.compile_rules(json.load(f))
+    processes = processes or os.cpu_count() or 1
+    logger.info(f"Replaying {', '.join(paths)} with {len(rules)} rules in {processes} processes...")
+
+    totals = {'emails': 0, 'bytes': 0, 'failed': 0, 'rules': Counter(), 'actions': Counter()}
+    context = multiprocessing.get_context()
+    log_queue = context.Queue()
+    listener = logs.listen_to_workers(log_queue)
+    report = open(report_file, 'w') if report_file else None
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(processes, mp_context=context, initializer=_init_replay_worker,
+                                 initargs=(log_queue, log_level, rules_file, max_body_size)) as pool:
+            for result in _ordered_map(pool, classify_batch, iter_batches(paths, batch_size), processes * 4):
+                for key in ('emails', 'bytes', 'failed'):
+                    totals[key] += result[key]
+                totals['rules'].update(result['rules'])
+                totals['actions'].update(result['actions'])
+                if report:
+                    for match in result['matches']:
+                        report.write(json.dumps(match) + '\n')
+    finally:
+        listener.stop()
+        if report:
+            report.close()
+    totals['seconds'] = elapsed = time.perf_counter() - start
+
+    logger.info(f"Replayed {totals['emails']} emails ({totals['bytes'] / 2**20:.1f} MiB) in {elapsed:.1f}s: "
+                f"{totals['emails'] / elapsed:.0f} emails/s, {totals['bytes'] / 2**20 / elapsed:.1f} MiB/s, "
+                f"{totals['failed']} unreadable.")
+    for rule in rules:
+        logger.info(f"Rule {rule.name}: {totals['rules'][rule.name]} matches")
+    for action, count in sorted(totals['actions'].items()):
+        logger.info(f"Would apply '{action}' {count} times")
+    if report_file:
+        logger.info(f"Wrote matches to {report_file}")
+    return totals
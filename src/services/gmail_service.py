@@ -1,20 +1,106 @@
 import base64
+import functools
 import logging
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from logs.logs import sample_debug
 from src.models.email import Email
+from src.services.pipeline import iter_emails_pipelined
+from src.services.rate_limiter import DEFAULT_QUOTA_UNITS_PER_SECOND, RequestExecutor, TokenBucket
+from src.utils import chunked
+import httplib2
 import os
+import threading
+import time
+import urllib.parse
 
 logger = logging.getLogger("gmail_processor")
 
+# Gmail rejects batch requests with more than 100 calls.
+MAX_BATCH_SIZE = 100
+# messages.list returns at most 500 ids per page.
+MAX_PAGE_SIZE = 500
+# messages.batchModify accepts at most 1000 ids per call.
+MAX_BATCH_MODIFY_SIZE = 1000
+
+
+# Email attribute -> header requested with format='metadata'.
+METADATA_HEADERS = {'sender': 'From', 'receiver': 'To', 'subject': 'Subject', 'received_date': 'Date'}
+
+
+class HistoryExpiredError(Exception):
+    """Raised when a stored historyId is too old for users.history.list."""
+
+
+class LabelNotFoundError(Exception):
+    """Raised when an action names a label that does not exist and is not created."""
+
+
 class GmailService:
-    def __init__(self, credentials_path, token_path, scopes):
+    def __init__(self, credentials_path, token_path, scopes, batch_size=None, service=None,
+                 label_cache_ttl=300, create_missing_labels=False, workers=0, service_factory=None,
+                 executor=None, max_body_size=None, api_endpoint=None):
         logger.info("Initializing GmailService...")
-        self.service = self._get_authenticated_service(credentials_path, token_path, scopes)
+        if batch_size is not None and not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}, got {batch_size}")
+        self.batch_size = batch_size
+        self.workers = workers
+        # Headers to fetch with format='metadata', or None to fetch format='raw'. See use_fields.
+        self.metadata_headers = None
+        # Rule fields the fetch format was chosen for by use_fields; None keeps format='raw'.
+        self.fields = None
+        # Bodies longer than this many bytes are truncated when parsed; None keeps them whole.
+        self.max_body_size = max_body_size
+        # Every API call goes through one executor so all threads share the quota budget.
+        self.executor = executor or RequestExecutor(TokenBucket(DEFAULT_QUOTA_UNITS_PER_SECOND))
+        self.label_cache_ttl = label_cache_ttl
+        self.create_missing_labels = create_missing_labels
+        # Case-folded label name -> label id, loaded lazily by get_label_id.
+        self._label_ids = None
+        self._missing_labels = set()
+        # Ids that parse_messages could not fetch or parse, until take_failed_ids; see sync_emails.
+        self._failed_ids = set()
+        self._failed_lock = threading.Lock()
+        self._labels_loaded_at = 0.0
+        # The discovery document's batch URI ignores api_endpoint, so batches are pointed at it explicitly.
+        self.batch_uri = urllib.parse.urljoin(api_endpoint, 'batch/gmail/v1') if api_endpoint else None
+        if service is None and service_factory is None:
+            client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+            if api_endpoint and urllib.parse.urlparse(api_endpoint).scheme == 'http':
+                # A local fake or emulator of the API; never send OAuth tokens over plain HTTP.
+                service_factory = lambda: build('gmail', 'v1', http=httplib2.Http(), client_options=client_options,
+                                                static_discovery=True)
+            else:
+                credentials = self._get_credentials(credentials_path, token_path, scopes)
+                service_factory = lambda: build('gmail', 'v1', credentials=credentials, client_options=client_options)
+        self._service_factory = service_factory
+        self._local = threading.local()
+        self._local.service = service
+
+    @property
+    def service(self):
+        """The API client owned by the calling thread.
+
+        googleapiclient service objects are not thread-safe, so each thread
+        builds its own client from the shared credentials on first use.
+        """
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            if self._service_factory is None:
+                raise RuntimeError("GmailService needs a service_factory to be used from worker threads")
+            service = self._local.service = self._service_factory()
+        return service
+
+    def new_batch(self, callback=None):
+        if self.batch_uri:
+            return BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+        return self.service.new_batch_http_request(callback=callback)
 
-    def _get_authenticated_service(self, credentials_path, token_path, scopes):
+    def _get_credentials(self, credentials_path, token_path, scopes):
         logger.info("Authenticating Gmail service...")
         creds = None
         if os.path.exists(token_path):
@@ -33,94 +119,387 @@ class GmailService:
             with open(token_path, 'w') as token:
                 token.write(creds.to_json())
         logger.info("Authentication successful.")
-        return build('gmail', 'v1', credentials=creds)
+        return creds
 
     def fetch_emails(self, max_results=100):
         logger.info(f"Fetching up to {max_results} emails...")
         try:
-            results = self.service.users().messages().list(userId='me', maxResults=max_results).execute()
-            messages = results.get('messages', [])
-            emails = []
-            for message in messages:
-                logger.debug(f"Processing message ID: {message['id']}")
-                raw_message = self.get_raw_message(message['id'])
-                if raw_message:
-                    email = Email.from_raw_message(raw_message, message['id'])
-                    logger.debug(f"Parsed email: {email}")
-                    emails.append(email)
+            emails = list(self.iter_emails(max_results))
             logger.info(f"Fetched {len(emails)} emails successfully.")
             return emails
         except Exception as e:
             logger.error(f"Error fetching emails: {e}")
             return []
 
+    def iter_emails(self, max_results=100):
+        """Lazily yield parsed emails, fetching one chunk of messages at a time.
+
+        At most one chunk of raw messages is held in memory, so the footprint
+        stays bounded no matter how many messages are requested.
+        """
+        return self.iter_emails_by_ids(self.iter_message_ids(max_results))
+
+    def iter_emails_by_ids(self, message_ids):
+        """Lazily fetch and parse the given message ids, one chunk at a time.
+
+        With `workers` set, chunks are fetched on a thread pool and parsed on a
+        separate thread while the caller consumes earlier results.
+        """
+        chunk_size = self.batch_size or MAX_BATCH_SIZE
+        if self.workers:
+            yield from iter_emails_pipelined(self, message_ids, self.workers, chunk_size)
+            return
+        for message_ids in chunked(message_ids, chunk_size):
+            yield from self.parse_messages(message_ids, self.fetch_messages(message_ids))
+
+    def use_fields(self, fields):
+        """Fetch only what rules over `fields` need.
+
+        Without a Message field, switches to format='metadata' with the
+        From, To, Subject and Date headers, which the store keeps whichever
+        of them the rules read. Rules that read the body keep format='raw',
+        so bodies come with the batched fetches instead of one request per
+        email.
+        """
+        self.fields = set(fields)
+        attributes = {Email.FIELD_MAPPING.get(field, field) for field in fields}
+        if 'message' in attributes:
+            self.metadata_headers = None
+            logger.info("Rules read message bodies, fetching raw messages")
+            return
+        self.metadata_headers = sorted(METADATA_HEADERS.values())
+        logger.info(f"Fetching message metadata only, with headers {self.metadata_headers}")
+
+    def fetch_messages(self, message_ids):
+        """Fetch one chunk of messages in the configured format, batched when batch_size is set."""
+        if self.metadata_headers is not None:
+            if self.batch_size:
+                messages, _ = self.get_metadata_messages(message_ids)
+                return messages
+            return {message_id: self.get_metadata_message(message_id) for message_id in message_ids}
+        if self.batch_size:
+            raw_messages, _ = self.get_raw_messages(message_ids)
+            return raw_messages
+        return {message_id: self.get_raw_message(message_id) for message_id in message_ids}
+
+    def parse_messages(self, message_ids, messages):
+        """Yield the parsed emails of one fetched chunk; ids that failed are kept for take_failed_ids."""
+        for message_id in message_ids:
+            debug = sample_debug(logger)
+            if debug:
+                logger.debug("Processing message ID: %s", message_id)
+            message = messages.pop(message_id, None)
+            email = None
+            if message:
+                if isinstance(message, bytes):
+                    email = Email.from_raw_message(message, message_id, self.max_body_size)
+                else:
+                    email = Email.from_metadata_message(
+                        message, message_id, body_loader=functools.partial(self.get_message_body, message_id)
+                    )
+            if email:
+                if debug:
+                    logger.debug("Parsed email: %r", email)
+                yield email
+            else:
+                with self._failed_lock:
+                    self._failed_ids.add(message_id)
+
+    def take_failed_ids(self):
+        """Return and forget the ids that could not be fetched or parsed since the last call."""
+        with self._failed_lock:
+            failed_ids, self._failed_ids = self._failed_ids, set()
+        return failed_ids
+
+    def iter_message_ids(self, max_results=100, page_size=MAX_PAGE_SIZE):
+        """Walk messages.list pages lazily, following nextPageToken."""
+        page_token = None
+        remaining = max_results
+        while remaining > 0:
+            try:
+                results = self.executor.execute(self.service.users().messages().list(
+                    userId='me', maxResults=min(page_size, remaining), pageToken=page_token
+                ), 'messages.list')
+            except Exception as e:
+                logger.error(f"Error listing messages: {e}")
+                raise
+            messages = results.get('messages', [])
+            logger.debug("Listed page of %d message IDs.", len(messages))
+            for message in messages[:remaining]:
+                yield message['id']
+            remaining -= len(messages)
+            page_token = results.get('nextPageToken')
+            if not page_token or not messages:
+                return
+
+    def get_history_id(self):
+        """Return the mailbox's current historyId."""
+        try:
+            profile = self.executor.execute(self.service.users().getProfile(userId='me'), 'getProfile')
+            return profile['historyId']
+        except Exception as e:
+            logger.error(f"Error fetching mailbox profile: {e}")
+            raise
+
+    def watch(self, topic_name, label_ids=('INBOX',)):
+        """Ask Gmail to publish mailbox changes to a Cloud Pub/Sub topic, e.g. "projects/p/topics/gmail".
+
+        Must be renewed at least every 7 days. Returns the response with the
+        current historyId and the expiration in epoch milliseconds.
+        """
+        try:
+            response = self.executor.execute(self.service.users().watch(userId='me', body={
+                'topicName': topic_name, 'labelIds': list(label_ids), 'labelFilterBehavior': 'include'
+            }), 'watch')
+        except Exception as e:
+            logger.error(f"Error watching the mailbox on {topic_name}: {e}")
+            raise
+        logger.info(f"Watching the mailbox on {topic_name} until {response.get('expiration')}")
+        return response
+
+    def stop_watch(self):
+        """Stop the push notifications started by watch."""
+        try:
+            self.executor.execute(self.service.users().stop(userId='me'), 'stop')
+        except Exception as e:
+            logger.error(f"Error stopping mailbox push notifications: {e}")
+            raise
+
+    def list_history_changes(self, start_history_id):
+        """Collect message ids changed since `start_history_id`.
+
+        Returns (changed_ids, deleted_ids, latest_history_id). Raises
+        HistoryExpiredError when Gmail no longer has history that far back.
+        """
+        logger.info(f"Listing mailbox history since {start_history_id}...")
+        changed_ids = {}
+        deleted_ids = set()
+        latest_history_id = start_history_id
+        page_token = None
+        while True:
+            try:
+                results = self.executor.execute(self.service.users().history().list(
+                    userId='me', startHistoryId=start_history_id, pageToken=page_token,
+                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+                ), 'history.list')
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise HistoryExpiredError(f"History ID {start_history_id} has expired") from e
+                logger.error(f"Error listing history since {start_history_id}: {e}")
+                raise
+            for record in results.get('history', []):
+                for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                    for change in record.get(key, []):
+                        changed_ids[change['message']['id']] = None
+                for change in record.get('messagesDeleted', []):
+                    deleted_ids.add(change['message']['id'])
+            latest_history_id = results.get('historyId', latest_history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        changed_ids = [message_id for message_id in changed_ids if message_id not in deleted_ids]
+        logger.info(f"Found {len(changed_ids)} changed and {len(deleted_ids)} deleted messages.")
+        return changed_ids, deleted_ids, latest_history_id
+
     def get_raw_message(self, message_id):
-        logger.info(f"Fetching raw message for ID: {message_id}")
+        logger.debug("Fetching raw message for ID: %s", message_id)
         try:
-            message = self.service.users().messages().get(userId='me', id=message_id, format='raw').execute()
+            message = self.executor.execute(
+                self.service.users().messages().get(userId='me', id=message_id, format='raw'), 'messages.get'
+            )
             return base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
         except Exception as e:
-            logger.error(f"Error fetching raw message for ID {message_id}: {e}")
+            logger.error("Error fetching raw message for ID %s: %s", message_id, e)
+            return None
+
+    def get_metadata_message(self, message_id):
+        logger.debug("Fetching message metadata for ID: %s", message_id)
+        try:
+            return self.executor.execute(self.service.users().messages().get(
+                userId='me', id=message_id, format='metadata', metadataHeaders=self.metadata_headers
+            ), 'messages.get')
+        except Exception as e:
+            logger.error("Error fetching message metadata for ID %s: %s", message_id, e)
             return None
 
+    def get_message_body(self, message_id):
+        """Fetch and parse just the body of a message fetched as metadata."""
+        raw_message = self.get_raw_message(message_id)
+        email = Email.from_raw_message(raw_message, message_id, self.max_body_size) if raw_message else None
+        return email.message if email else None
+
+    def get_raw_messages(self, message_ids, batch_size=None):
+        """Fetch raw messages in batched HTTP requests.
+
+        Returns a tuple of ({message_id: raw_bytes}, {message_id: exception}).
+        A failed message is reported on its own and does not fail its batch.
+        """
+        return self._get_messages_batched(
+            message_ids, batch_size, lambda response: base64.urlsafe_b64decode(response['raw'].encode('ASCII')),
+            format='raw'
+        )
+
+    def get_metadata_messages(self, message_ids, batch_size=None):
+        """Fetch format='metadata' message resources with only metadata_headers, batched like get_raw_messages."""
+        return self._get_messages_batched(
+            message_ids, batch_size, None, format='metadata', metadataHeaders=self.metadata_headers
+        )
+
+    def _get_messages_batched(self, message_ids, batch_size, decode, **params):
+        batch_size = batch_size or self.batch_size or MAX_BATCH_SIZE
+        messages = {}
+        failed = {}
+
+        for start in range(0, len(message_ids), batch_size):
+            chunk = message_ids[start:start + batch_size]
+            logger.info("Fetching batch of %d %s messages...", len(chunk), params['format'])
+            requests = {
+                message_id: (lambda message_id=message_id: self.service.users().messages().get(
+                    userId='me', id=message_id, **params))
+                for message_id in chunk
+            }
+            responses, errors = self.executor.execute_batch(self.new_batch, requests, 'messages.get')
+            for message_id, exception in errors.items():
+                logger.error("Error fetching %s message for ID %s: %s", params['format'], message_id, exception)
+                failed[message_id] = exception
+            for message_id, response in responses.items():
+                try:
+                    messages[message_id] = decode(response) if decode else response
+                except Exception as e:
+                    logger.error("Error decoding %s message for ID %s: %s", params['format'], message_id, e)
+                    failed[message_id] = e
+
+        if failed:
+            logger.warning(f"Failed to fetch {len(failed)} of {len(message_ids)} messages.")
+        return messages, failed
+
     def mark_as_read(self, message_id):
-        logger.info(f"Marking message {message_id} as read...")
+        logger.info("Marking message %s as read...", message_id)
         try:
-            self.service.users().messages().modify(
+            self.executor.execute(self.service.users().messages().modify(
                 userId='me', 
                 id=message_id, 
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
-            logger.info(f"Message {message_id} marked as read.")
+            ), 'messages.modify')
+            logger.info("Message %s marked as read.", message_id)
         except Exception as e:
-            logger.error(f"Error marking message {message_id} as read: {e}")
+            logger.error("Error marking message %s as read: %s", message_id, e)
             raise e
 
     def mark_as_unread(self, message_id):
-        logger.info(f"Marking message {message_id} as unread...")
+        logger.info("Marking message %s as unread...", message_id)
         try:
-            self.service.users().messages().modify(
+            self.executor.execute(self.service.users().messages().modify(
                 userId='me', 
                 id=message_id, 
                 body={'addLabelIds': ['UNREAD']}
-            ).execute()
-            logger.info(f"Message {message_id} marked as unread.")
+            ), 'messages.modify')
+            logger.info("Message %s marked as unread.", message_id)
         except Exception as e:
-            logger.error(f"Error marking message {message_id} as unread: {e}")
-    
+            logger.error("Error marking message %s as unread: %s", message_id, e)
+            raise e
+
+    def batch_modify(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """Apply one label change to many messages with messages.batchModify.
+
+        Returns a tuple of (modified_ids, {message_id: exception}); a failed
+        call only fails the ids it carried.
+        """
+        body = {}
+        if add_label_ids:
+            body['addLabelIds'] = list(add_label_ids)
+        if remove_label_ids:
+            body['removeLabelIds'] = list(remove_label_ids)
+        modified_ids = []
+        failed = {}
+        for start in range(0, len(message_ids), MAX_BATCH_MODIFY_SIZE):
+            chunk = message_ids[start:start + MAX_BATCH_MODIFY_SIZE]
+            logger.info("Modifying labels on %d messages: %s", len(chunk), body)
+            try:
+                self.executor.execute(
+                    self.service.users().messages().batchModify(userId='me', body=dict(body, ids=chunk)),
+                    'messages.batchModify'
+                )
+                modified_ids.extend(chunk)
+            except Exception as e:
+                logger.error(f"Error modifying labels on {len(chunk)} messages: {e}")
+                failed.update((message_id, e) for message_id in chunk)
+        return modified_ids, failed
+
     def move_message(self, message_id, destination_name):
-        logger.info(f"Moving message {message_id} to label '{destination_name}'...")
+        logger.info("Moving message %s to label '%s'...", message_id, destination_name)
         label_id = self.get_label_id(destination_name)
         if not label_id:
-            logger.error(f"Label '{destination_name}' not found. Unable to move message {message_id}.")
-            return
+            logger.error("Label '%s' not found. Unable to move message %s.", destination_name, message_id)
+            raise LabelNotFoundError(f"Label '{destination_name}' not found")
         try:
-            self.service.users().messages().modify(
+            self.executor.execute(self.service.users().messages().modify(
                 userId='me', 
                 id=message_id, 
                 body={'addLabelIds': [label_id]}
-            ).execute()
-            logger.info(f"Message {message_id} moved to label '{destination_name}'.")
+            ), 'messages.modify')
+            logger.info("Message %s moved to label '%s'.", message_id, destination_name)
         except Exception as e:
-            logger.error(f"Error moving message {message_id} to label '{destination_name}': {e}")
+            logger.error("Error moving message %s to label '%s': %s", message_id, destination_name, e)
             raise e
 
     def get_label_id(self, label_name):
-        logger.info(f"Fetching label ID for label name: '{label_name}'...")
-        try:
-            results = self.service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
-            for label in labels:
-                if label['name'].lower() == label_name.lower():
-                    logger.debug(f"Found label '{label_name}' with ID: {label['id']}")
-                    return label['id']
+        """Resolve a label name to its id from the session label cache.
+
+        The cache is reloaded after label_cache_ttl seconds, and once on a miss
+        in case the label was created since. Missing labels are created when
+        create_missing_labels is set.
+        """
+        key = label_name.casefold()
+        refreshed = False
+        if self._label_ids is None or time.monotonic() - self._labels_loaded_at > self.label_cache_ttl:
+            self.refresh_labels()
+            refreshed = True
+        label_id = self._label_ids.get(key)
+        if label_id is None and not refreshed and key not in self._missing_labels:
+            self.refresh_labels()
+            label_id = self._label_ids.get(key)
+        if label_id is None:
+            if self.create_missing_labels:
+                return self.create_label(label_name)
+            self._missing_labels.add(key)
             logger.warning(f"Label '{label_name}' not found.")
             return None
+        logger.debug("Found label '%s' with ID: %s", label_name, label_id)
+        return label_id
+
+    def refresh_labels(self):
+        logger.info("Fetching labels...")
+        try:
+            results = self.executor.execute(self.service.users().labels().list(userId='me'), 'labels.list')
         except Exception as e:
             logger.error(f"Error fetching labels: {e}")
             raise e
+        self._label_ids = {label['name'].casefold(): label['id'] for label in results.get('labels', [])}
+        self._missing_labels.clear()
+        self._labels_loaded_at = time.monotonic()
+
+    def create_label(self, label_name):
+        logger.info(f"Creating label '{label_name}'...")
+        try:
+            label = self.executor.execute(self.service.users().labels().create(
+                userId='me',
+                body={'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+            ), 'labels.create')
+        except Exception as e:
+            logger.error(f"Error creating label '{label_name}': {e}")
+            raise e
+        self._label_ids[label_name.casefold()] = label['id']
+        self._missing_labels.discard(label_name.casefold())
+        return label['id']
 
 
-def get_gmail_service(credential_file, token_file, scopes):
+def get_gmail_service(credential_file, token_file, scopes, batch_size=None, label_cache_ttl=300,
+                      create_missing_labels=False, workers=0,
+                      quota_units_per_second=DEFAULT_QUOTA_UNITS_PER_SECOND, max_retries=5, max_body_size=None,
+                      api_endpoint=None):
     logger.info("Creating GmailService instance...")
-    return GmailService(credential_file, token_file, scopes)
+    executor = RequestExecutor(TokenBucket(quota_units_per_second), max_retries=max_retries)
+    return GmailService(credential_file, token_file, scopes, batch_size=batch_size,
+                        label_cache_ttl=label_cache_ttl, create_missing_labels=create_missing_labels,
+                        workers=workers, executor=executor, max_body_size=max_body_size, api_endpoint=api_endpoint)
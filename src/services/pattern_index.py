@@ -0,0 +1,77 @@
+try:
+    import ahocorasick  # Optional C implementation (pip install pyahocorasick).
+except ImportError:
+    ahocorasick = None
+
+# Below this many patterns, separate `in` scans (memchr speed in C) beat one
+# pure-Python automaton pass; the C automaton wins almost immediately.
+MIN_INDEXED_PATTERNS = 4 if ahocorasick is not None else 128
+
+
+class PatternIndex:
+    """Aho-Corasick automaton that finds which of a fixed set of substrings occur in a text.
+
+    One search scans the text once, however many patterns there are. Uses
+    pyahocorasick when it is installed and a pure-Python automaton otherwise.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = frozenset(pattern for pattern in patterns if pattern)
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for pattern in self.patterns:
+                self._automaton.add_word(pattern, pattern)
+            self._automaton.make_automaton()
+            self.search = self._search_native
+        else:
+            self._build()
+            self.search = self._search_python
+
+    def _build(self):
+        goto = [{}]
+        outputs = [set()]
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    outputs.append(set())
+                state = next_state
+            outputs[state].add(pattern)
+
+        # Breadth-first failure links; each state inherits the outputs of its failure state.
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, next_state in goto[state].items():
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                outputs[next_state] |= outputs[fail[next_state]]
+                queue.append(next_state)
+
+        # Resolve failure links into a full transition table so the scan never backtracks.
+        for state in queue:
+            for char, next_state in goto[fail[state]].items():
+                goto[state].setdefault(char, next_state)
+        self._goto = goto
+        self._outputs = [frozenset(output) for output in outputs]
+
+    def _search_python(self, text):
+        goto = self._goto
+        outputs = self._outputs
+        root = goto[0]
+        found = set()
+        state = 0
+        for char in text:
+            state = goto[state].get(char) or root.get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+    def _search_native(self, text):
+        return {pattern for _, pattern in self._automaton.iter(text)}
@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import chunked
+
+logger = logging.getLogger("gmail_processor")
+
+_DONE = object()
+# How often blocked stages wake up to check whether the consumer has gone away.
+_POLL_INTERVAL = 0.1
+
+
+def iter_emails_pipelined(gmail_service, message_ids, workers, chunk_size, max_pending_chunks=None):
+    """Fetch, parse and yield emails with the stages running concurrently.
+
+    Chunks of ids are fetched on a pool of `workers` threads, each using its
+    own API client through GmailService.service. A separate thread parses
+    fetched chunks, and the caller consumes parsed emails on its own thread,
+    so it stays the only SQLite writer. At most `max_pending_chunks` chunks
+    (default 2 * workers) are fetched but not yet consumed, so a slow
+    consumer throttles fetching.
+    """
+    max_pending_chunks = max_pending_chunks or 2 * workers
+    pending = threading.BoundedSemaphore(max_pending_chunks)
+    fetched_chunks = queue.Queue()
+    parsed_chunks = queue.Queue(maxsize=max_pending_chunks)
+    stopping = threading.Event()
+
+    def put_parsed(item):
+        while not stopping.is_set():
+            try:
+                parsed_chunks.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(chunk):
+        try:
+            messages = gmail_service.fetch_messages(chunk)
+        except Exception as e:
+            logger.error(f"Error fetching chunk of {len(chunk)} messages: {e}")
+            messages = {}
+        fetched_chunks.put((chunk, messages))
+
+    def produce():
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gmail-fetch') as pool:
+                for chunk in chunked(message_ids, chunk_size):
+                    while not pending.acquire(timeout=_POLL_INTERVAL):
+                        if stopping.is_set():
+                            return
+                    if stopping.is_set():
+                        return
+                    pool.submit(fetch, chunk)
+        except Exception as e:
+            logger.error(f"Error listing messages for the fetch pipeline: {e}")
+            fetched_chunks.put(e)
+        finally:
+            fetched_chunks.put(_DONE)
+
+    def parse():
+        while True:
+            item = fetched_chunks.get()
+            if item is _DONE:
+                put_parsed(_DONE)
+                return
+            if isinstance(item, Exception):
+                put_parsed(item)
+                continue
+            chunk, messages = item
+            emails = list(gmail_service.parse_messages(chunk, messages))
+            pending.release()
+            put_parsed(emails)
+
+    threads = [
+        threading.Thread(target=produce, name='gmail-fetch-producer', daemon=True),
+        threading.Thread(target=parse, name='gmail-parse', daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = parsed_chunks.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+    finally:
+        stopping.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,201 @@
+import logging
+import random
+import threading
+import time
+from googleapiclient.errors import HttpError
+from src.metrics import metrics
+
+logger = logging.getLogger("gmail_processor")
+
+# Gmail API quota units per call, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'labels.create': 5,
+    'history.list': 2,
+    'getProfile': 1,
+    'watch': 100,
+    'stop': 50,
+}
+
+# Gmail allows 250 quota units per user per second; stay a little under it.
+DEFAULT_QUOTA_UNITS_PER_SECOND = 240
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+class TokenBucket:
+    """Thread-safe token bucket metering Gmail quota units.
+
+    The refill rate backs off multiplicatively when the API throttles us and
+    creeps back towards `max_rate` on success, so sustained throughput settles
+    just under the quota ceiling.
+    """
+
+    def __init__(self, max_rate, capacity=None, min_rate=None):
+        self.max_rate = max_rate
+        self.min_rate = min_rate or max_rate / 16
+        self.rate = max_rate
+        self.capacity = capacity or max_rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        """Take `units` tokens, sleeping until they are available. Returns the seconds waited.
+
+        A request costing more than the capacity, such as a full batch, is
+        charged in full: the balance goes negative and later callers wait it off.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Reserve the tokens even when short, so concurrent callers queue up fairly.
+            self._tokens -= units
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def slow_down(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RequestExecutor:
+    """Runs Gmail API requests through a shared TokenBucket with retries.
+
+    Retryable errors (429, 5xx, 403 rate limits and transport errors) are
+    retried with exponential backoff and full jitter. Counters for retries
+    and throttle waits are kept for the end-of-run summary.
+    """
+
+    def __init__(self, bucket, max_retries=5, base_delay=1.0, max_delay=32.0):
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.retries = 0
+        self.throttle_waits = 0
+        self.throttle_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def execute(self, request, method):
+        with metrics.timer('gmail_request_seconds', "Gmail API call latency, including throttling and retries.",
+                           method=method):
+            attempt = 0
+            while True:
+                self._acquire(method)
+                try:
+                    response = request.execute()
+                    self.bucket.speed_up()
+                    return response
+                except Exception as e:
+                    if not self.is_retryable(e) or attempt >= self.max_retries:
+                        raise
+                    self._backoff(method, attempt, e)
+                    attempt += 1
+
+    def execute_batch(self, new_batch, requests, method):
+        """Run {request_id: request factory} as batch HTTP requests, retrying only the calls that failed retryably.
+
+        Returns ({request_id: response}, {request_id: exception}).
+        """
+        with metrics.timer('gmail_batch_seconds', "Gmail batch HTTP latency, including throttling and retries.",
+                           method=method):
+            return self._execute_batch(new_batch, requests, method)
+
+    def _execute_batch(self, new_batch, requests, method):
+        responses = {}
+        failed = {}
+        pending = list(requests)
+        attempt = 0
+        while pending:
+            retry = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    responses[request_id] = response
+                else:
+                    failed[request_id] = exception
+                    if self.is_retryable(exception):
+                        retry.append(request_id)
+
+            self._acquire(method, len(pending))
+            batch = new_batch(callback=callback)
+            for request_id in pending:
+                batch.add(requests[request_id](), request_id=request_id)
+            try:
+                batch.execute()
+            except Exception as e:
+                for request_id in pending:
+                    if request_id not in responses:
+                        failed[request_id] = e
+                retry = [request_id for request_id in pending if request_id not in responses] \
+                    if self.is_retryable(e) else []
+            if not retry:
+                self.bucket.speed_up()
+                break
+            if attempt >= self.max_retries:
+                break
+            self._backoff(method, attempt, failed[retry[0]], len(retry))
+            for request_id in retry:
+                del failed[request_id]
+            pending = retry
+            attempt += 1
+        return responses, failed
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttle_waits': self.throttle_waits,
+            'throttle_wait_seconds': round(self.throttle_wait_seconds, 3),
+            'rate': round(self.bucket.rate, 1),
+        }
+
+    def _acquire(self, method, count=1):
+        waited = self.bucket.acquire(QUOTA_UNITS.get(method, 5) * count)
+        with self._lock:
+            self.requests += count
+            if waited:
+                self.throttle_waits += 1
+                self.throttle_wait_seconds += waited
+
+    def _backoff(self, method, attempt, error, count=1):
+        if self.is_rate_limited(error):
+            self.bucket.slow_down()
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self._lock:
+            self.retries += count
+        metrics.inc('gmail_retries_total', "Gmail API calls retried.", count, method=method)
+        logger.warning(f"Retrying {count} {method} call(s) in {delay:.2f}s after: {error}")
+        time.sleep(delay)
+
+    @staticmethod
+    def is_rate_limited(error):
+        if not isinstance(error, HttpError):
+            return False
+        if error.resp.status == 429:
+            return True
+        return error.resp.status == 403 and any(
+            detail.get('reason') in RATE_LIMIT_REASONS for detail in (error.error_details or [])
+            if isinstance(detail, dict)
+        )
+
+    @classmethod
+    def is_retryable(cls, error):
+        if isinstance(error, HttpError):
+            return error.resp.status in RETRYABLE_STATUSES or cls.is_rate_limited(error)
+        return isinstance(error, (ConnectionError, TimeoutError))
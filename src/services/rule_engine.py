@@ -1,66 +1,148 @@
+import hashlib
 import json
 import logging
-from src.utils import compare_dates, parse_date, parse_date_time
+from logs.logs import sample_debug
+from src.metrics import metrics
+from src.models.email import Email
+from src.services.pattern_index import MIN_INDEXED_PATTERNS, PatternIndex
+from src.utils import parse_date, unit_delta
 
 logger = logging.getLogger("gmail_processor")
+
+PREDICATES = {
+    'Contains': lambda condition_value: lambda email_value: condition_value in email_value,
+    'Does not Contain': lambda condition_value: lambda email_value: condition_value not in email_value,
+    'Equals': lambda condition_value: lambda email_value: email_value == condition_value,
+    'Does not equal': lambda condition_value: lambda email_value: email_value != condition_value,
+}
+
+# Conditions on these fields are evaluated last so cheaper header checks can short-circuit first.
+EXPENSIVE_FIELDS = {'Message'}
+
+SUBSTRING_PREDICATES = ('Contains', 'Does not Contain')
+
+
+def _never(context):
+    return False
+
+
+def date_threshold(value):
+    """Return the epoch-seconds cutoff of a received_date condition value, or None if invalid."""
+    try:
+        comparison_date = parse_date(value['date'])
+        delta = unit_delta(value.get('unit', 'days'), value.get('value', 0))
+        if comparison_date is None or delta is None:
+            return None
+        return int((comparison_date + delta).timestamp())
+    except (AttributeError, KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+
+class EvaluationContext:
+    """Per-email state shared by every rule: the email and its pattern index matches."""
+    __slots__ = ('email', '_indexes', '_found')
+
+    def __init__(self, email, indexes=None):
+        self.email = email
+        self._indexes = indexes
+        self._found = {}
+
+    def found(self, attribute):
+        """Return the indexed patterns present in a field, scanning it at most once per email."""
+        try:
+            return self._found[attribute]
+        except KeyError:
+            value = getattr(self.email, attribute, None)
+            found = self._indexes[attribute].search(value) if isinstance(value, str) else None
+            self._found[attribute] = found
+            return found
+
+
 class Rule:
-    def __init__(self, rule_data):
+    def __init__(self, rule_data, indexes=None, name=None):
         self.conditions = rule_data['conditions']
         self.predicate = rule_data['predicate']
         self.actions = rule_data['actions']
+        self.name = rule_data.get('name', name)
+        self.compile(indexes)
+
+    def compile(self, indexes=None):
+        """Compile the conditions into a single short-circuiting predicate over an EvaluationContext.
 
-    def evaluate(self, email):
-        logger.debug(f"Evaluating rule with predicate '{self.predicate}' for email {email.id}")
-        condition_results = [self.evaluate_condition(cond, email) for cond in self.conditions]
-        result = all(condition_results) if self.predicate == 'All' else any(condition_results)
-        logger.debug(f"Rule evaluation result: {result} for email {email.id}")
+        Substring conditions on a field in `indexes` read the shared per-email
+        match set instead of scanning the field themselves.
+        """
+        self.indexes = indexes or {}
+        ordered = sorted(self.conditions, key=lambda condition: condition['field'] in EXPENSIVE_FIELDS)
+        checks = tuple(self.compile_condition(condition, self.indexes) for condition in ordered)
+        if self.predicate == 'All':
+            self.matches = lambda context: all(check(context) for check in checks)
+        else:
+            self.matches = lambda context: any(check(context) for check in checks)
+        # Wrapped only while metrics are enabled, so disabled runs evaluate the bare closure.
+        self.matches = metrics.timed(self.matches, 'rule_evaluation_seconds', "Time to evaluate one rule on one email.",
+                                     rule=self.name)
+
+    def evaluate(self, email, context=None):
+        result = self.matches(context or EvaluationContext(email, self.indexes))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Rule %s evaluated to %s for email %s", self.name, result, email.id)
         return result
 
-    def evaluate_condition(self, condition, email):
+    @staticmethod
+    def compile_condition(condition, indexes):
         field = condition['field']
         predicate = condition['predicate']
         value = condition['value']
 
-        try:
-            logger.debug(f"Evaluating condition: {field} {predicate} {value} for email {email.id}")
-            if field == 'received_date':
-                email_date = parse_date_time(email.received_date)
-                comparison_date = parse_date(value['date'])
-                if email_date and comparison_date:
-                    result = compare_dates(
-                        email_date, comparison_date, predicate,
-                        value.get('unit', 'days'), value.get('value', 0)
-                    )
-                    logger.debug(f"Condition result for received_date: {result} for email {email.id}")
-                    return result
-                return False
-
-            email_value = email.get_field(field)
-            if email_value is None:
-                logger.warning(f"Field '{field}' not found on email object for email {email.id}")
-                return False
-
-            if isinstance(email_value, str):
-                result = self.apply_predicate(predicate, email_value, value)
-                logger.debug(f"Condition result for field {field}: {result} for email {email.id}")
-                return result
-
-        except Exception as e:
-            logger.error(f"Error evaluating condition {condition} for email {email.id}: {e}")
-        return False
+        if field == 'received_date':
+            threshold = date_threshold(value)
+            if threshold is None or predicate not in ('less than', 'greater than'):
+                logger.warning(f"Unsupported date condition: {condition}")
+                return _never
 
-    @staticmethod
-    def apply_predicate(predicate, email_value, condition_value):
-        if predicate == 'Contains':
-            return condition_value in email_value
-        elif predicate == 'Does not Contain':
-            return condition_value not in email_value
-        elif predicate == 'Equals':
-            return email_value == condition_value
-        elif predicate == 'Does not equal':
-            return email_value != condition_value
-        logger.warning(f"Unsupported predicate: {predicate}")
-        return False
+            if predicate == 'less than':
+                def check(context):
+                    received_ts = context.email.received_ts
+                    return received_ts is not None and received_ts < threshold
+            else:
+                def check(context):
+                    received_ts = context.email.received_ts
+                    return received_ts is not None and received_ts > threshold
+            return check
+
+        if predicate not in PREDICATES:
+            logger.warning(f"Unsupported predicate: {predicate}")
+            return _never
+        if predicate in SUBSTRING_PREDICATES and not isinstance(value, str):
+            # A substring test of a non-string raises TypeError, which would abort the run.
+            logger.warning(f"Condition value must be a string: {condition}")
+            return _never
+        attribute = Email.FIELD_MAPPING.get(field, field)
+
+        if predicate in SUBSTRING_PREDICATES and not value:
+            # Every string contains "", and PatternIndex cannot report an empty pattern as found.
+            if predicate == 'Contains':
+                return lambda context: isinstance(getattr(context.email, attribute, None), str)
+            return _never
+
+        if predicate in SUBSTRING_PREDICATES and attribute in indexes:
+            if predicate == 'Contains':
+                def check(context):
+                    found = context.found(attribute)
+                    return found is not None and value in found
+            else:
+                def check(context):
+                    found = context.found(attribute)
+                    return found is not None and value not in found
+            return check
+
+        test = PREDICATES[predicate](value)
+
+        def check(context):
+            email_value = getattr(context.email, attribute, None)
+            return isinstance(email_value, str) and test(email_value)
+        return check
 
     def __str__(self):
         conditions_str = [f"{cond['field']} {cond['predicate']} {cond['value']}" for cond in self.conditions]
@@ -68,45 +150,276 @@ class Rule:
         return f"Rule: {'All' if self.predicate == 'All' else 'Any'} of Conditions\n" + \
                "\n".join(conditions_str) + "\nActions:\n" + "\n".join(actions_str)
 
-
 class RuleEngine:
-    def __init__(self, rules_file, gmail_service, stop_after_first_match=True):
-        self.rules = self.load_rules(rules_file)
+    def __init__(self, rules_file, gmail_service, stop_after_first_match=True, batch_actions=False,
+                 compiled_rules=None, decision_cache=False):
+        # compiled_rules is a (rules, indexes) pair from compile_rules, shared by engines for several accounts.
+        if compiled_rules is None:
+            self.rules = self.load_rules(rules_file)
+        else:
+            self.rules, self.indexes = compiled_rules
         self.gmail_service = gmail_service
         self.stop_after_first_match = stop_after_first_match
+        self.batch_actions = batch_actions
+        # (label ids to add, label ids to remove) -> [(email id, resulting status)]
+        self.pending_actions = {}
+        # With decision_cache, emails whose stored decision is still current are skipped; see decision_hash.
+        self.decision_cache = decision_cache
+        self.rule_hashes, self.ruleset_hash = self.hash_rules(self.rules, self.stop_after_first_match)
+        # email id -> indices of the rules that matched it, saved by the caller via take_decisions
+        self.decisions = {}
         logger.info(f"Loaded {len(self.rules)} rules from {rules_file}")
 
     def load_rules(self, rules_file):
+        # Rules compile their conditions on construction, so evaluation does no parsing or dispatch.
         with open(rules_file, 'r') as f:
-            rules = [Rule(rule_data) for rule_data in json.load(f)]
-            logger.debug(f"Rules loaded: {rules}")
-            return rules
-
-    def process_email(self, email):
-        logger.info(f"Processing email {email.id}")
-        for rule in self.rules:
-            if rule.evaluate(email):
-                logger.info(f"Rule matched: {rule}")
-                self.apply_actions(rule, email)
+            rules, self.indexes = self.compile_rules(json.load(f))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Rules loaded: %s", [str(rule) for rule in rules])
+        return rules
+
+    def reload_rules(self, rules_file):
+        """Replace the rules with those in `rules_file`; if it is invalid, raise and keep the current ones."""
+        self.rules = self.load_rules(rules_file)
+        self.rule_hashes, self.ruleset_hash = self.hash_rules(self.rules, self.stop_after_first_match)
+        logger.info(f"Reloaded {len(self.rules)} rules from {rules_file}")
+
+    @classmethod
+    def compile_rules(cls, rules_data):
+        """Compile a parsed rules file into (rules, indexes)."""
+        rules = [Rule(rule_data, name=str(index)) for index, rule_data in enumerate(rules_data)]
+        indexes = cls.build_indexes(rules)
+        if indexes:
+            for rule in rules:
+                rule.compile(indexes)
+        return rules, indexes
+
+    @staticmethod
+    def build_indexes(rules, min_patterns=MIN_INDEXED_PATTERNS):
+        """Build one PatternIndex per field from every rule's Contains/Does not Contain values.
+
+        Fields with fewer than `min_patterns` distinct values keep plain `in` scans.
+        """
+        patterns = {}
+        for rule in rules:
+            for condition in rule.conditions:
+                if condition['predicate'] in SUBSTRING_PREDICATES and isinstance(condition['value'], str) \
+                        and condition['value']:
+                    attribute = Email.FIELD_MAPPING.get(condition['field'], condition['field'])
+                    patterns.setdefault(attribute, set()).add(condition['value'])
+        indexes = {}
+        for attribute, values in patterns.items():
+            if len(values) >= min_patterns:
+                indexes[attribute] = PatternIndex(values)
+                logger.info(f"Indexed {len(values)} substring patterns for field '{attribute}'")
+        return indexes
+
+    @staticmethod
+    def hash_rules(rules, stop_after_first_match=True):
+        """Return (a hash per rule covering it and every rule before it, a hash of the whole rule set)."""
+        digest = hashlib.blake2b(b'first' if stop_after_first_match else b'all', digest_size=16)
+        rule_hashes = []
+        for rule in rules:
+            digest.update(json.dumps([rule.predicate, rule.conditions, rule.actions], sort_keys=True).encode())
+            rule_hashes.append(digest.hexdigest())
+        digest.update(b'end')
+        return rule_hashes, digest.hexdigest()
+
+    def decision_hash(self, matched):
+        """Return the rules hash a decision matching rule indices `matched` stays valid under.
+
+        When evaluation stops at the first match, a match by rule i depends only
+        on rules 0..i, so editing a later rule keeps it. Anything else depends on
+        the whole rule set.
+        """
+        if matched and self.stop_after_first_match:
+            return self.rule_hashes[matched[0]] if matched[0] < len(self.rule_hashes) else None
+        return self.ruleset_hash
+
+    def current_decision(self, email, decision):
+        """Return the matched rule indices of a stored (fingerprint, rules hash, matched rules JSON)
+        decision if it still holds for `email`, else None."""
+        fingerprint, rules_hash, rules = decision
+        if fingerprint != email.fingerprint:
+            return None
+        matched = json.loads(rules)
+        return matched if rules_hash == self.decision_hash(matched) else None
+
+    def decided_status(self, matched, status=None):
+        """Return the status the actions of rules `matched` leave an email in."""
+        for index in matched:
+            for action in self.rules[index].actions:
+                if action['action'] == 'Mark as read':
+                    status = 'read'
+                elif action['action'] == 'Mark as unread':
+                    status = 'unread'
+        return status
+
+    def record_decisions(self, email_ids, index):
+        """Note that rule `index` matched `email_ids`, for take_decisions."""
+        if self.decision_cache:
+            for email_id in email_ids:
+                self.decisions.setdefault(email_id, []).append(index)
+
+    def take_decisions(self):
+        """Return and clear the decisions made so far as (email id, rules hash, matched rules JSON,
+        applied actions JSON) rows for EmailRepository.save_decisions."""
+        decisions, self.decisions = self.decisions, {}
+        return [
+            (email_id, self.decision_hash(matched), json.dumps(matched),
+             json.dumps([action for index in matched for action in self.rules[index].actions]))
+            for email_id, matched in decisions.items()
+        ]
+
+    def required_fields(self):
+        """Return the email fields any loaded rule reads, e.g. {'From', 'received_date'}."""
+        return {condition['field'] for rule in self.rules for condition in rule.conditions}
+
+    def process_email(self, email, decision=None):
+        """Evaluate the rules on an email and apply the matching rules' actions.
+
+        `decision` is the email's stored decision from EmailRepository.get_decisions;
+        if it still holds, evaluation and actions are skipped. Returns the indices
+        of the rules that matched.
+        """
+        # Decided once per email, so sampling keeps or drops all of an email's debug lines together.
+        debug = sample_debug(logger)
+        if self.decision_cache:
+            # Fingerprinted as fetched, before evaluation loads or decodes the body.
+            email.fingerprint
+        if decision is not None and self.decision_cache:
+            matched_rules = self.current_decision(email, decision)
+            if matched_rules is not None:
+                if debug:
+                    logger.debug("Reusing the stored rule decision for email %s", email.id)
+                metrics.inc('rule_decisions_reused_total', "Emails whose stored rule decision was reused.")
+                # The actions were applied in Gmail; only the local status needs restoring.
+                email.status = self.decided_status(matched_rules, email.status)
+                return matched_rules
+        if debug:
+            logger.debug("Processing email %s", email.id)
+        context = EvaluationContext(email, self.indexes)
+        matched_rules = []
+        applied = True
+        for index, rule in enumerate(self.rules):
+            matched = rule.matches(context)
+            if debug:
+                logger.debug("Rule %s evaluated to %s for email %s", rule.name, matched, email.id)
+            if matched:
+                logger.info("Rule %s matched email %s", rule.name, email.id)
+                if debug:
+                    logger.debug("Matched rule %s: %s", rule.name, rule)
+                matched_rules.append(index)
+                applied = self.apply_actions(rule, email) and applied
                 if self.stop_after_first_match:
-                    logger.debug(f"Stopping further rule processing for email {email.id}")
+                    if debug:
+                        logger.debug("Stopping further rule processing for email %s", email.id)
                     break
         else:
-            logger.debug(f"No rules matched for email {email.id}")
+            if debug:
+                logger.debug("No rules matched for email %s", email.id)
+        # Emails whose actions failed are left undecided, so the next run retries them.
+        if self.decision_cache and applied:
+            self.decisions[email.id] = matched_rules
+        return matched_rules
 
     def apply_actions(self, rule, email):
+        """Apply or queue a rule's actions; returns False if one of them failed."""
+        if self.batch_actions:
+            return self.queue_actions(rule, email)
+        applied = True
+        for action in rule.actions:
+            try:
+                with metrics.timer('rule_action_seconds', "Latency of applying a rule action.", action=action['action']):
+                    self.apply_action(action, email)
+            except Exception as e:
+                logger.error("Failed to apply action %s for email %s: %s", action, email.id, e)
+                applied = False
+        return applied
+
+    def apply_action(self, action, email):
+        logger.info("Applying action '%s' for email %s", action['action'], email.id)
+        if action['action'] == 'Mark as read':
+            self.gmail_service.mark_as_read(email.id)
+            email.status = 'read'
+        elif action['action'] == 'Mark as unread':
+            self.gmail_service.mark_as_unread(email.id)
+            email.status = 'unread'
+        elif action['action'] == 'Move Message':
+            destination = action.get('destination')
+            self.gmail_service.move_message(email.id, destination)
+            logger.info("Moved email %s to %s", email.id, destination)
+
+    def queue_actions(self, rule, email):
+        """Fold a rule's actions into one label change and queue it for flush_actions.
+
+        Returns False if one of the actions could not be resolved.
+        """
+        return self.queue_rule_actions(rule, [email.id])
+
+    def queue_rule_actions(self, rule, email_ids):
+        """Queue a rule's label change for every email it matched.
+
+        The actions that resolve are queued even if others fail, as when they
+        are applied one by one. Returns False if one of them failed, so the
+        caller leaves the emails undecided.
+        """
+        add_labels, remove_labels, status, complete = self.label_change(rule)
+        if email_ids and (add_labels or remove_labels):
+            # Called once per matched email; flush_actions logs one INFO line per label change.
+            if sample_debug(logger):
+                logger.debug("Queued label change +%s -%s for %d emails", sorted(add_labels), sorted(remove_labels),
+                             len(email_ids))
+            key = (frozenset(add_labels), frozenset(remove_labels))
+            self.pending_actions.setdefault(key, []).extend((email_id, status) for email_id in email_ids)
+        return complete
+
+    def label_change(self, rule):
+        """Return (label ids to add, label ids to remove, resulting status, whether every action resolved)
+        for a rule's actions."""
+        add_labels, remove_labels, status, complete = set(), set(), None, True
         for action in rule.actions:
             try:
-                logger.info(f"Applying action '{action['action']}' for email {email.id}")
                 if action['action'] == 'Mark as read':
-                    self.gmail_service.mark_as_read(email.id)
-                    email.status = 'read'
+                    remove_labels.add('UNREAD')
+                    add_labels.discard('UNREAD')
+                    status = 'read'
                 elif action['action'] == 'Mark as unread':
-                    self.gmail_service.mark_as_unread(email.id)
-                    email.status = 'unread'
+                    add_labels.add('UNREAD')
+                    remove_labels.discard('UNREAD')
+                    status = 'unread'
                 elif action['action'] == 'Move Message':
                     destination = action.get('destination')
-                    self.gmail_service.move_message(email.id, destination)
-                    logger.info(f"Moved email {email.id} to {destination}")
+                    label_id = self.gmail_service.get_label_id(destination)
+                    if not label_id:
+                        logger.error(f"Label '{destination}' not found. Unable to move messages.")
+                        complete = False
+                        continue
+                    add_labels.add(label_id)
             except Exception as e:
-                logger.error(f"Failed to apply action {action} for email {email.id}: {e}")
+                logger.error(f"Failed to queue action {action}: {e}")
+                complete = False
+        return add_labels, remove_labels, status, complete
+
+    def flush_actions(self):
+        """Send queued label changes with one batchModify per distinct change.
+
+        Returns (email id, status) pairs for the emails whose status changed.
+        """
+        updated = []
+        pending, self.pending_actions = self.pending_actions, {}
+        for (add_labels, remove_labels), entries in pending.items():
+            message_ids = [email_id for email_id, _ in entries]
+            with metrics.timer('rule_action_seconds', "Latency of applying a rule action.", action='batchModify'):
+                modified_ids, failed = self.gmail_service.batch_modify(
+                    message_ids, sorted(add_labels), sorted(remove_labels)
+                )
+            for email_id, status in entries:
+                if email_id in failed:
+                    logger.error("Failed to apply queued actions for email %s: %s", email_id, failed[email_id])
+                    self.decisions.pop(email_id, None)
+                elif status:
+                    updated.append((email_id, status))
+            logger.info("Applied label change +%s -%s to %d emails.", sorted(add_labels), sorted(remove_labels),
+                        len(modified_ids))
+        return updated
@@ -0,0 +1,268 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import json
+import logging
+import math
+import os
+import time
+
+from src.metrics import metrics
+
+logger = logging.getLogger("gmail_processor")
+
+# Gmail stops pushing notifications 7 days after users.watch; it asks for a renewal once a day.
+WATCH_RENEW_SECONDS = 24 * 3600
+
+
+class SocketNotifications:
+    """Local stand-in for Gmail push notifications: each line sent to a TCP port is one notification.
+
+    A line may be a Gmail notification payload such as {"historyId": "1234"},
+    or anything else to just ask for a sync, e.g. `echo | nc 127.0.0.1 <port>`.
+    """
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._writers = set()
+
+    async def start(self, notify):
+        async def handle(reader, writer):
+            self._writers.add(writer)
+            try:
+                while line := await reader.readline():
+                    try:
+                        history_id = json.loads(line).get('historyId')
+                    except (ValueError, AttributeError):
+                        history_id = None
+                    notify(history_id)
+            finally:
+                self._writers.discard(writer)
+                writer.close()
+
+        self._server = await asyncio.start_server(handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Listening for notifications on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Ends the handlers' reads, so they exit before the event loop goes away.
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            await asyncio.sleep(0)
+
+
+class PubSubNotifications:
+    """Gmail push notifications pulled from a Cloud Pub/Sub subscription, e.g. "projects/p/subscriptions/gmail".
+
+    Needs the google-cloud-pubsub package and Application Default Credentials
+    allowed to read the subscription.
+    """
+
+    def __init__(self, subscription):
+        self.subscription = subscription
+        self._subscriber = None
+        self._streaming_pull = None
+
+    async def start(self, notify):
+        try:
+            from google.cloud import pubsub_v1
+        except ImportError as e:
+            raise RuntimeError("Pub/Sub notifications need the google-cloud-pubsub package") from e
+        loop = asyncio.get_running_loop()
+
+        def callback(message):
+            # Runs on the subscriber's threads; notify belongs to the event loop.
+            try:
+                history_id = json.loads(message.data).get('historyId')
+            except ValueError:
+                history_id = None
+            message.ack()
+            loop.call_soon_threadsafe(notify, history_id)
+
+        self._subscriber = pubsub_v1.SubscriberClient()
+        self._streaming_pull = self._subscriber.subscribe(self.subscription, callback)
+        logger.info(f"Pulling notifications from {self.subscription}")
+
+    async def stop(self):
+        if self._streaming_pull is not None:
+            self._streaming_pull.cancel()
+            self._subscriber.close()
+
+
+class WatchDaemon:
+    """Keep the Gmail service, SQLite connection and compiled rules warm, and sync as new mail arrives.
+
+    `initialize` returns (email_repo, gmail_service, rule_engine) and
+    `sync(gmail_service, email_repo, rule_engine)` processes what changed since
+    the last sync, returning the number of emails processed. Both run on one
+    dedicated thread, as does every other call on the services, since SQLite
+    connections are bound to the thread that opened them.
+
+    A sync runs at start, after each notification from `sources` (notifications
+    arriving within `batch_window` seconds are handled together), and every
+    `poll_interval` seconds without one. The rules are reloaded between syncs
+    when `rules_file` changes. With `topic_name`, Gmail is asked to publish
+    mailbox changes there, for PubSubNotifications to pull.
+    """
+
+    def __init__(self, initialize, sync, rules_file, sources=(), poll_interval=None, batch_window=0.05,
+                 rules_check_interval=1.0, topic_name=None):
+        self.initialize = initialize
+        self.sync = sync
+        self.rules_file = rules_file
+        self.sources = list(sources)
+        self.poll_interval = poll_interval or None
+        self.batch_window = batch_window
+        self.rules_check_interval = rules_check_interval
+        self.topic_name = topic_name
+        self.email_repo = self.gmail_service = self.rule_engine = None
+        self.syncs = 0
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="watch")
+        self._wake = None
+        self._stopping = False
+        self._notified_at = None
+        self._history_id = None
+        # Highest historyId announced since the current sync began; inf once a notification came without one.
+        self._notified_history_id = 0
+
+    def _call(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._thread, functools.partial(func, *args))
+
+    def notify(self, history_id=None):
+        """Ask for a sync. Notifications for history already synced are ignored. Call on the event loop."""
+        if history_id and self._history_id and int(history_id) <= int(self._history_id):
+            return
+        self._notified_history_id = max(self._notified_history_id, int(history_id) if history_id else math.inf)
+        if self._notified_at is None:
+            self._notified_at = time.perf_counter()
+        self._wake.set()
+
+    def stop(self):
+        """Finish the sync in progress, if any, then shut down. Call on the event loop."""
+        self._stopping = True
+        self._wake.set()
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        self.email_repo, self.gmail_service, self.rule_engine = await self._call(self.initialize)
+        self._history_id = await self._call(self.email_repo.get_history_id)
+        tasks = [asyncio.create_task(self._watch_rules())]
+        if self.topic_name:
+            tasks.append(asyncio.create_task(self._renew_watch()))
+        try:
+            for source in self.sources:
+                await source.start(self.notify)
+            # Catch up on mail that arrived while the daemon was not running.
+            self.notify()
+            while True:
+                await self._wait()
+                if self._stopping:
+                    break
+                await self._sync()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for source in self.sources:
+                await source.stop()
+            if self.topic_name:
+                try:
+                    await self._call(self.gmail_service.stop_watch)
+                except Exception:
+                    pass  # Logged by stop_watch; the watch lapses on its own within 7 days.
+            await self._call(self.email_repo._conn.close)
+            self._thread.shutdown()
+            logger.info(f"Watch daemon stopped after {self.syncs} syncs.")
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            self._notified_at = time.perf_counter()
+            return
+        # Let the rest of a burst arrive, so it is fetched as one micro-batch.
+        await asyncio.sleep(self.batch_window)
+
+    async def _sync(self):
+        notified_at, self._notified_at = self._notified_at, None
+        self._notified_history_id = 0
+        self._wake.clear()
+        try:
+            with metrics.timer('watch_sync_seconds', "Duration of one watch-mode sync."):
+                processed = await self._call(self.sync, self.gmail_service, self.email_repo, self.rule_engine)
+            self._history_id = await self._call(self.email_repo.get_history_id)
+        except Exception as e:
+            # The next notification or poll retries.
+            logger.error(f"Watch sync failed: {e}")
+            return
+        self.syncs += 1
+        latency = time.perf_counter() - notified_at
+        if metrics.enabled:
+            metrics.histogram('watch_notification_latency_seconds',
+                              "Time from a notification to its emails being processed.").observe(latency)
+        if not processed:
+            return
+        logger.info(f"Processed {processed} emails {latency * 1000:.0f} ms after notification.")
+        try:
+            self._history_id = await self._call(self._skip_own_changes)
+        except Exception as e:
+            logger.warning(f"Could not check the mailbox history after a sync: {e}")
+            return
+        if self._wake.is_set() and not self._stopping and self._notified_history_id <= int(self._history_id):
+            # Only the echoes of our own label changes arrived during the sync.
+            self._wake.clear()
+            self._notified_at = None
+
+    def _skip_own_changes(self):
+        """Advance the stored historyId past the label changes a sync just made, if nothing else happened since.
+
+        The historyId a sync stores comes from history.list before its batchModify calls, so
+        without this the notifications those calls cause would each trigger another sync.
+        Returns the stored historyId.
+        """
+        history_id = self.email_repo.get_history_id()
+        changed_ids, deleted_ids, latest_history_id = self.gmail_service.list_history_changes(history_id)
+        # The same test an incremental sync applies: changes to stored messages need no fetch.
+        if not deleted_ids and len(self.email_repo.get_existing_ids(changed_ids)) == len(changed_ids):
+            self.email_repo.set_history_id(latest_history_id)
+            return latest_history_id
+        return history_id
+
+    async def _watch_rules(self):
+        mtime = _mtime(self.rules_file)
+        while True:
+            await asyncio.sleep(self.rules_check_interval)
+            current = _mtime(self.rules_file)
+            if current == mtime:
+                continue
+            mtime = current
+            try:
+                # On the services thread, so a reload never lands in the middle of a sync.
+                await self._call(self._reload_rules)
+            except Exception as e:
+                logger.error(f"Keeping the current rules, {self.rules_file} could not be loaded: {e}")
+
+    def _reload_rules(self):
+        self.rule_engine.reload_rules(self.rules_file)
+        # With FETCH_FORMAT "auto", the fetch format follows the fields the new rules read.
+        if self.gmail_service.fields is not None:
+            self.gmail_service.use_fields(self.rule_engine.required_fields())
+
+    async def _renew_watch(self):
+        while True:
+            try:
+                await self._call(self.gmail_service.watch, self.topic_name)
+            except Exception as e:
+                logger.error(f"Could not renew the Gmail watch, relying on polling: {e}")
+            await asyncio.sleep(WATCH_RENEW_SECONDS)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
@@ -1,4 +1,6 @@
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_tz
+from itertools import islice
 import logging
 
 
@@ -8,6 +10,20 @@ logger = logging.getLogger("gmail_processor")
 
 
 def parse_date_time(date_string):
+    if isinstance(date_string, datetime):
+        # Freshly parsed emails carry a datetime; rows read back from SQLite carry text.
+        return date_string if date_string.tzinfo else date_string.replace(tzinfo=timezone.utc)
+    if not date_string:
+        return None
+
+    # Fast path for RFC 2822 Date headers, which is what nearly every message carries
+    parsed = parsedate_tz(date_string)
+    if parsed is not None:
+        try:
+            return datetime(*parsed[:6], tzinfo=timezone(timedelta(seconds=parsed[9] or 0)))
+        except ValueError:
+            pass
+
     formats = [
         "%a, %d %b %Y %H:%M:%S %z",  # Date with timezone offset
         "%a, %d %b %Y %H:%M:%S %Z",  # Date with named timezone
@@ -33,6 +49,14 @@ def parse_date_time(date_string):
 
 
 
+def to_timestamp(value):
+    """Normalize a Date header, stored date text or datetime to integer UTC epoch seconds."""
+    if value is None or isinstance(value, int):
+        return value
+    date_time = parse_date_time(value)
+    return int(date_time.timestamp()) if date_time else None
+
+
 def parse_date(date_string):
     try:
         return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=timezone.utc)
@@ -40,12 +64,17 @@ def parse_date(date_string):
         return None
 
 
-def compare_dates(date1, date2, operator, unit, value):
+def unit_delta(unit, value):
     if unit == 'days':
-        delta = timedelta(days=value)
+        return timedelta(days=value)
     elif unit == 'months':
-        delta = timedelta(days=value * 30)
-    else:
+        return timedelta(days=value * 30)
+    return None
+
+
+def compare_dates(date1, date2, operator, unit, value):
+    delta = unit_delta(unit, value)
+    if delta is None:
         return False
 
     if operator == 'less than':
@@ -53,3 +82,13 @@ def compare_dates(date1, date2, operator, unit, value):
     elif operator == 'greater than':
         return date1 > date2 + delta
     return False
+
+
+def chunked(iterable, size):
+    """Yield lists of up to `size` items from `iterable` without materializing it."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,14 @@
+import pytest
+
+from benchmarks.fake_gmail import build_fake_service
+from src.services.gmail_service import GmailService
+from src.services.rate_limiter import RequestExecutor, TokenBucket
+
+
+@pytest.fixture
+def fake_gmail_service():
+    """Return a factory for GmailServices talking to a FakeGmailHttp, with an effectively unlimited quota."""
+    def make(http, batch_size=10, **kwargs):
+        return GmailService(None, None, None, batch_size=batch_size, service=build_fake_service(http),
+                            executor=RequestExecutor(TokenBucket(1_000_000), max_retries=0), **kwargs)
+    return make
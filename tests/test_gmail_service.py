@@ -0,0 +1,24 @@
+from benchmarks.fake_gmail import FakeGmailHttp, make_mailbox
+
+
+def test_header_rules_fetch_metadata_only(fake_gmail_service):
+    http = FakeGmailHttp(make_mailbox(5))
+    gmail_service = fake_gmail_service(http)
+    gmail_service.use_fields({'From', 'received_date'})
+
+    emails = list(gmail_service.iter_emails(5))
+    assert gmail_service.metadata_headers == ['Date', 'From', 'Subject', 'To']
+    assert [email.loaded_message for email in emails] == [None] * 5
+
+
+def test_body_rules_fetch_raw_messages_in_batches(fake_gmail_service):
+    http = FakeGmailHttp(make_mailbox(20))
+    gmail_service = fake_gmail_service(http)
+    gmail_service.use_fields({'From'})
+    gmail_service.use_fields({'From', 'Message'})
+
+    emails = list(gmail_service.iter_emails(20))
+    assert gmail_service.metadata_headers is None
+    assert all(email.loaded_message for email in emails)
+    # One messages.list page and two batches of ten; no per-email body requests.
+    assert http.round_trips == 3
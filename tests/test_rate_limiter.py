@@ -0,0 +1,10 @@
+import pytest
+
+from src.services.rate_limiter import TokenBucket
+
+
+def test_requests_larger_than_the_capacity_are_charged_in_full():
+    bucket = TokenBucket(1000, capacity=10)
+    assert bucket.acquire(110) == pytest.approx(0.1, abs=0.02)
+    # The debt of the oversized request delays the next caller too.
+    assert bucket.acquire(10) > 0
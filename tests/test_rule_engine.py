@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from benchmarks.fake_gmail import FakeGmailHttp
+from src.models.email import Email
+from src.services.pattern_index import MIN_INDEXED_PATTERNS
+from src.services.rule_engine import RuleEngine
+
+
+def make_email(subject):
+    return Email("1", "sender@example.com", "me@example.com", subject, "body", "Mon, 12 Aug 2024 10:00:00 +0000")
+
+
+def test_invalid_condition_values_never_match():
+    rules, _ = RuleEngine.compile_rules([{"predicate": "Any", "conditions": [
+        {"field": "Subject", "predicate": "Contains", "value": 5},
+        {"field": "From", "predicate": "Does not Contain", "value": ["x"]},
+        {"field": "received_date", "predicate": "less than", "value": "2024-01-01"},
+        {"field": "received_date", "predicate": "less than", "value": {"date": "2024-01-01", "value": "x"}},
+        {"field": "Subject", "predicate": "Equals", "value": "hello"},
+    ], "actions": [{"action": "Mark as read"}]}])
+
+    assert rules[0].evaluate(make_email("hello"))
+    assert not rules[0].evaluate(make_email("goodbye"))
+
+
+def test_empty_substring_values_match_like_plain_scans():
+    conditions = [{"field": "Subject", "predicate": "Contains", "value": f"pattern{index}"}
+                  for index in range(MIN_INDEXED_PATTERNS)]
+    rules, indexes = RuleEngine.compile_rules([
+        {"predicate": "Any", "conditions": conditions, "actions": [{"action": "Mark as read"}]},
+        {"predicate": "All", "conditions": [{"field": "Subject", "predicate": "Contains", "value": ""}],
+         "actions": [{"action": "Mark as read"}]},
+        {"predicate": "All", "conditions": [{"field": "Subject", "predicate": "Does not Contain", "value": ""}],
+         "actions": [{"action": "Mark as read"}]},
+    ])
+
+    assert "subject" in indexes
+    assert not rules[0].evaluate(make_email("hello"))
+    assert rules[1].evaluate(make_email("hello"))
+    assert not rules[2].evaluate(make_email("hello"))
+
+
+@pytest.mark.parametrize("batch_actions", [True, False])
+def test_failed_actions_leave_the_email_undecided(tmp_path, fake_gmail_service, batch_actions):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps([{
+        "predicate": "All", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "hello"}],
+        "actions": [{"action": "Move Message", "destination": "Archive"}],
+    }]))
+    http = FakeGmailHttp({})
+    gmail_service = fake_gmail_service(http, label_cache_ttl=0)
+    rule_engine = RuleEngine(str(rules_file), gmail_service, batch_actions=batch_actions, decision_cache=True)
+
+    rule_engine.process_email(make_email("hello"))
+    rule_engine.flush_actions()
+    assert rule_engine.take_decisions() == []
+
+    http.labels["Label_9"] = "Archive"
+    rule_engine.process_email(make_email("hello"))
+    rule_engine.flush_actions()
+    assert [decision[0] for decision in rule_engine.take_decisions()] == ["1"]
+    assert "Label_9" in http.message_labels["1"]
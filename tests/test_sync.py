@@ -0,0 +1,144 @@
+import json
+
+import pytest
+
+import main
+from benchmarks.fake_gmail import FakeGmailHttp, make_mailbox, make_raw_message
+from src.repositories.email_repository import get_email_repository
+from src.services.rule_engine import RuleEngine
+
+RULES = [{"predicate": "Any", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "Synthetic"}],
+          "actions": [{"action": "Mark as read"}]}]
+
+
+@pytest.fixture
+def mailbox(tmp_path, fake_gmail_service):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps(RULES))
+    http = FakeGmailHttp(make_mailbox(20))
+    gmail_service = fake_gmail_service(http)
+    email_repo = get_email_repository(str(tmp_path / "emails.db"))
+    email_repo.create_table()
+    rule_engine = RuleEngine(str(rules_file), gmail_service, batch_actions=True)
+    yield http, gmail_service, email_repo, rule_engine
+    email_repo._conn.close()
+
+
+def stored_ids(email_repo):
+    return {email.id for email in email_repo.get_all()}
+
+
+def test_first_sync_is_a_full_resync(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    history_id = http.history_id
+    assert main.sync_emails(gmail_service, email_repo, rule_engine, 100) == 20
+    assert stored_ids(email_repo) == set(http.mailbox)
+    # The history as listed before the sync's own label changes.
+    assert email_repo.get_history_id() == str(history_id)
+
+
+def test_incremental_sync_fetches_only_new_messages(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    http.add_message("new1", make_raw_message(100))
+    http.add_message("new2", make_raw_message(101))
+    history_id = http.history_id
+
+    assert main.sync_emails(gmail_service, email_repo, rule_engine, 100) == 2
+    assert {"new1", "new2"} <= stored_ids(email_repo)
+    assert email_repo.get_by_id("new1").status == 'read'
+    assert email_repo.get_history_id() == str(history_id)
+
+
+def test_incremental_sync_removes_deleted_messages(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    http.delete_message("msg00000003")
+
+    assert main.sync_emails(gmail_service, email_repo, rule_engine, 100) == 0
+    assert "msg00000003" not in stored_ids(email_repo)
+    assert len(stored_ids(email_repo)) == 19
+
+
+def test_expired_history_falls_back_to_a_full_resync(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    http.add_message("new1", make_raw_message(100))
+    history_id = http.history_id
+    http.oldest_history_id = history_id + 1
+
+    assert main.sync_emails(gmail_service, email_repo, rule_engine, 100) == 21
+    assert "new1" in stored_ids(email_repo)
+    assert email_repo.get_history_id() == str(history_id)
+
+
+def test_failed_messages_are_retried_by_the_next_sync(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    http.failing_ids.add("new1")
+    http.add_message("new1", make_raw_message(100))
+    http.add_message("new2", make_raw_message(101))
+
+    assert main.sync_emails(gmail_service, email_repo, rule_engine, 100) == 1
+    assert "new1" not in stored_ids(email_repo)
+    assert email_repo.get_failed_ids() == ["new1"]
+
+    http.failing_ids.clear()
+    assert main.sync_emails(gmail_service, email_repo, rule_engine, 100) == 1
+    assert "new1" in stored_ids(email_repo)
+    assert email_repo.get_failed_ids() == []
+
+
+def test_failed_messages_deleted_before_the_retry_are_dropped(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    http.failing_ids.add("new1")
+    http.add_message("new1", make_raw_message(100))
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+
+    http.delete_message("new1")
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    assert email_repo.get_failed_ids() == []
+
+
+def test_metadata_sync_stores_every_header(mailbox):
+    http, gmail_service, email_repo, rule_engine = mailbox
+    gmail_service.use_fields(rule_engine.required_fields())
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+
+    email = email_repo.get_by_id("msg00000003")
+    assert email.sender and email.receiver and email.subject and email.received_date
+    assert email_repo.get_message_body("msg00000003") is None
+
+
+def test_reprocess_matches_headers_the_syncing_rules_did_not_read(mailbox, tmp_path):
+    http, gmail_service, email_repo, _ = mailbox
+    rules_file = tmp_path / "subject_rules.json"
+    rules_file.write_text(json.dumps([{"predicate": "All", "actions": [{"action": "Mark as read"}], "conditions": [
+        {"field": "Subject", "predicate": "Equals", "value": "nothing"}]}]))
+    rule_engine = RuleEngine(str(rules_file), gmail_service, batch_actions=True)
+    gmail_service.use_fields(rule_engine.required_fields())
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+
+    rules_file.write_text(json.dumps([{"predicate": "All", "actions": [{"action": "Mark as read"}], "conditions": [
+        {"field": "From", "predicate": "Contains", "value": "sender1"}]}]))
+    rule_engine = RuleEngine(str(rules_file), gmail_service, batch_actions=True)
+    # sender1 and sender10 through sender19.
+    assert main.reprocess_stored_emails(email_repo, rule_engine, gmail_service) == 11
+
+
+def test_reprocess_loads_bodies_of_metadata_only_emails(mailbox, tmp_path):
+    http, gmail_service, email_repo, _ = mailbox
+    rules_file = tmp_path / "header_rules.json"
+    rules_file.write_text(json.dumps([{"predicate": "All", "actions": [{"action": "Mark as read"}], "conditions": [
+        {"field": "From", "predicate": "Equals", "value": "nobody@example.com"}]}]))
+    rule_engine = RuleEngine(str(rules_file), gmail_service, batch_actions=True)
+    gmail_service.use_fields(rule_engine.required_fields())
+    main.sync_emails(gmail_service, email_repo, rule_engine, 100)
+    assert email_repo.get_message_body("msg00000003") is None
+
+    rules_file.write_text(json.dumps([{"predicate": "All", "actions": [{"action": "Mark as read"}], "conditions": [
+        {"field": "Message", "predicate": "Contains", "value": "message 3."}]}]))
+    rule_engine = RuleEngine(str(rules_file), gmail_service, batch_actions=True)
+    assert main.reprocess_stored_emails(email_repo, rule_engine, gmail_service) == 1
+    assert email_repo.get_by_id("msg00000003").status == 'read'
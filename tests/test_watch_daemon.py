@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+import main
+from benchmarks.fake_gmail import FakeGmailHttp, make_mailbox, make_raw_message
+from src.repositories.email_repository import get_email_repository
+from src.services.rule_engine import RuleEngine
+from src.services.watch_daemon import SocketNotifications, WatchDaemon
+
+RULES = [{"predicate": "Any", "conditions": [{"field": "Subject", "predicate": "Contains", "value": "Synthetic"}],
+          "actions": [{"action": "Mark as read"}]}]
+
+
+async def wait_for(condition, timeout=5.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_notifications_for_our_own_label_changes_are_ignored(tmp_path, fake_gmail_service):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps(RULES))
+    http = FakeGmailHttp(make_mailbox(5))
+
+    def initialize():
+        gmail_service = fake_gmail_service(http)
+        email_repo = get_email_repository(str(tmp_path / "emails.db"))
+        email_repo.create_table()
+        return email_repo, gmail_service, RuleEngine(str(rules_file), gmail_service, batch_actions=True)
+
+    async def run():
+        source = SocketNotifications(0)
+        daemon = WatchDaemon(initialize, lambda *services: main.sync_emails(*services, 100), str(rules_file),
+                             [source], batch_window=0.01)
+        task = asyncio.create_task(daemon.run())
+        await wait_for(lambda: daemon.syncs == 1)
+        _, writer = await asyncio.open_connection("127.0.0.1", source.port)
+
+        http.add_message("new1", make_raw_message(100))
+        writer.write(json.dumps({"historyId": str(http.history_id)}).encode() + b"\n")
+        await wait_for(lambda: "UNREAD" not in http.message_labels.get("new1", {"UNREAD"}))
+        await wait_for(lambda: daemon.syncs == 2)
+
+        # The notification Gmail sends for the sync's own batchModify.
+        writer.write(json.dumps({"historyId": str(http.history_id)}).encode() + b"\n")
+        await writer.drain()
+        await asyncio.sleep(0.2)
+        syncs = daemon.syncs
+        writer.close()
+        daemon.stop()
+        await task
+        return syncs
+
+    assert asyncio.run(run()) == 2